@@ -1,31 +1,96 @@
+import asyncio
 import importlib
+import json
 import os
-from copy import deepcopy
-from typing import Callable
+import re
+import threading
+from typing import Any, Callable
 
 from .datastore import BaseStore, ConfigObject
 
 
+# A reference to another object, the format is #|:obj_type:obj_name:|#
+_REF_RE = re.compile(r'^#\|:([^:]+):([^:]+):\|#$')
+
+
+# Objects already built by instantiate_from_config, keyed by their type, class and (resolved) parameters
+_instance_cache: dict[tuple, Any] = {}
+# One lock per key, so two threads do not build the same object twice (each with its own pools, tables checks...),
+# while different objects can still be built at the same time. _cache_lock guards both dicts
+_instance_locks: dict[tuple, threading.Lock] = {}
+_cache_lock = threading.Lock()
+
+
+def clear_instance_cache():
+    with _cache_lock:
+        _instance_cache.clear()
+        _instance_locks.clear()
+
+
+def _instance_key(config: ConfigObject, params: dict) -> tuple:
+    # Referenced objects are already shared through the cache, so their identity is enough to tell them apart
+    canonical_params = json.dumps(params, sort_keys=True,
+                                  default=lambda o: f'{type(o).__qualname__}@{id(o)}')
+    return (config.type, config.instance, canonical_params)
+
+
 def instantiate_from_config(config: ConfigObject, store: BaseStore):
+    # A shallow copy is enough, we only replace top level values. Nested values are passed as they are
+    params = dict(config.metadata)
+    for k, v in params.items():
+        # lets see if the parameter is a reference to another object
+        if isinstance(v, str) and (ref := _REF_RE.match(v)):
+            ref_config = store.get_config(ref.group(1), ref.group(2))
+            params[k] = instantiate_from_config(ref_config, store)
+
+    return _get_instance(config, params)
+
+
+async def ainstantiate_from_config(config: ConfigObject, store: BaseStore):
+    """
+    Async version of instantiate_from_config, the referenced objects are loaded (and built) concurrently.
+    """
+    params = dict(config.metadata)
+    refs = {k: ref for k, v in params.items()
+            if isinstance(v, str) and (ref := _REF_RE.match(v))}
+    if refs:
+        instances = await asyncio.gather(*[_aresolve_reference(ref.group(1), ref.group(2), store)
+                                           for ref in refs.values()])
+        params.update(zip(refs.keys(), instances))
+
+    return _get_instance(config, params)
+
+
+async def _aresolve_reference(object_type: str, object_name: str, store: BaseStore):
+    ref_config = await store.aget_config(object_type, object_name)
+    return await ainstantiate_from_config(ref_config, store)
+
+
+def _get_instance(config: ConfigObject, params: dict):
     # Import the module using the type, use relative import to know where the module is located
     module = importlib.import_module("." + config.type, 'agentutil')
 
     # Get the class from the module using the instance name
     cls = getattr(module, config.instance)
 
-    params = deepcopy(config.metadata)
-    for k in params.keys():
-        # lets see if the parameter is a reference to another object, the format is #|:obj_type:obj_name:|#'
-        if isinstance(params[k], str) and params[k].startswith('#|:') and params[k].endswith(':|#'):
-            ref = params[k].split(':')
-            config = store.get_config(ref[1], ref[2])
-            obj = instantiate_from_config(config, store)
-            params[k] = obj
-
-    # Instantiate the class with the metadata as parameters
-    instance = cls(**params)
+    # Reuse the instance if we already built this same object, so it (and its clients/connections) are shared
+    key = _instance_key(config, params)
+    with _cache_lock:
+        if key in _instance_cache:
+            return _instance_cache[key]
+        lock = _instance_locks.setdefault(key, threading.Lock())
 
-    return instance
+    with lock:
+        # Another thread may have built it while we waited
+        with _cache_lock:
+            if key in _instance_cache:
+                return _instance_cache[key]
+        # Instantiate the class with the metadata as parameters
+        instance = cls(**params)
+        with _cache_lock:
+            _instance_cache[key] = instance
+            _instance_locks.pop(key, None)
+        return instance
 
 
 class SecretRetriever():
@@ -1,5 +1,5 @@
 
-from typing import Annotated, Dict, List, TypedDict
+from typing import Annotated, Callable, Dict, List, TypedDict
 
 from autogen import (ConversableAgent, GroupChat, GroupChatManager,
                      UserProxyAgent)
@@ -21,21 +21,32 @@ class AutogenConfig(TypedDict):
                                      'Additional parameters to be passed to the agent llm config such as temperatura']
 
 
+def _termination_check(assistant_name: str) -> Callable[[dict], bool]:
+    def is_termination_msg(msg: dict) -> bool:
+        if msg.get('content') and "TERMINATE" in msg["content"]:
+            return True
+        # If the assistant did not ask for a tool, it already gave its answer, there is no need for another round.
+        # Only its replies count, a message from any other agent (without tool calls) does not end the chat
+        return msg.get('name') == assistant_name and not msg.get('tool_calls') and not msg.get('function_call')
+    return is_termination_msg
+
+
 class AutogenBasicAgent(ToolAgent):
     def __init__(self,  agent_config: AutogenConfig, max_rounds: int = 10, rag_databases: list[RAGDatabase] = [], tools: list[BasicTool] = [], additional_agents: list[AutogenConfig] = [], chat_manager: AutogenConfig = None):
         super().__init__(rag_databases=rag_databases, tools=tools)
+        self.max_rounds = max_rounds
 
+        assistant_name = agent_config.get('name', 'assistant')
         self.user_proxy = UserProxyAgent(
             name='user_proxy',
             code_execution_config=False,
             human_input_mode='NEVER',
             llm_config=None,
-            is_termination_msg=lambda msg: 'content' in msg and msg[
-                'content'] and "TERMINATE" in msg["content"],
+            is_termination_msg=_termination_check(assistant_name),
         )
 
         self.llm_agent = ConversableAgent(
-            name=agent_config.get('name', 'assistant'),
+            name=assistant_name,
             system_message=agent_config.get('system_prompt', None),
             code_execution_config=False,
             description=agent_config.get('description', None),
@@ -53,28 +64,23 @@ class AutogenBasicAgent(ToolAgent):
 
         chat_input = self._retrieve_rag_information(messages)
 
-        # Send the history of the chat to the agent, so he knows what we are talking about
-        self.user_proxy.clear_history(self.llm_agent)
-        self.llm_agent.clear_history(self.user_proxy)
-
-        for m in chat_input:
-            if m['role'] == 'user':
-                self.user_proxy.send(
-                    message=m, recipient=self.llm_agent, request_reply=False, silent=True)
-            else:
-                self.llm_agent.send(
-                    message=m, recipient=self.user_proxy, request_reply=False, silent=True)
+        # The previous messages go, in one shot, as the carryover (context) of the last one.
+        # initiate_chat clears the history of both agents before starting
+        history = '\n'.join(f"{m['role']}: {m['content']}" for m in chat_input[:-1])
+        kwargs = {'carryover': history} if history else {}
 
         res = self.user_proxy.initiate_chat(
             recipient=self.llm_agent,
-            clear_history=False,
+            clear_history=True,
             message=chat_input[-1]['content'],
-            max_turns=10
+            max_turns=self.max_rounds,
+            **kwargs
         )
 
         # print(f'{res=}')
         if res:
-            answer = res.chat_history[-1]['content'].removesuffix(
+            # If we ran out of rounds on a tool call there is no content
+            answer = (res.chat_history[-1]['content'] or '').removesuffix(
                 'TERMINATE').strip()
         else:
             answer = 'SEM RESPOSTA'
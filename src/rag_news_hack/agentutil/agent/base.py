@@ -1,3 +1,4 @@
+import asyncio
 import time
 import uuid
 from abc import ABC, abstractmethod
@@ -34,7 +35,7 @@ class SimpleAgent(ABC):
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": message_content.encode(encoding='utf-8').decode(encoding='utf-8'),
+                        "content": message_content,
                     },
                     "finish_reason": finish_reason,
                     "logprobs": 0.0
@@ -60,25 +61,55 @@ class SimpleAgent(ABC):
         if not self.rag_databases:
             return messages
 
+        query_texts = [message['content']
+                       for message in self._rag_relevant_messages(messages)]
+        rag_results = []
+
+        # Query RAG databases for relevant content, sending all the messages to each database at once
+        for database in self.rag_databases:
+            for result in database.query_texts(query_texts):
+                rag_results.extend(result)
+
+        return self._append_rag_results(messages, rag_results)
+
+    async def _aretrieve_rag_information(self, messages: list) -> list[dict]:
+        """
+        Async version of _retrieve_rag_information. The databases are queried concurrently
+        instead of one after the other.
+
+        :param messages: A list of dictionaries with keys "role" and "content".
+        :return: A modified list of messages including relevant RAG information.
+        """
+        if not self.rag_databases:
+            return messages
+
+        query_texts = [message['content']
+                       for message in self._rag_relevant_messages(messages)]
+        tasks = [database.aquery_texts(query_texts)
+                 for database in self.rag_databases]
+
+        rag_results = []
+        for database_results in await asyncio.gather(*tasks):
+            for result in database_results:
+                rag_results.extend(result)
+
+        return self._append_rag_results(messages, rag_results)
+
+    def _rag_relevant_messages(self, messages: list) -> list[dict]:
         # Filter relevant messages (do not include system messages)
         relevant_messages = [
             m for m in messages if m['role'] in ('user', 'assistant')]
-        relevant_messages = relevant_messages if self.rag_on_all_messages else [
+        return relevant_messages if self.rag_on_all_messages else [
             relevant_messages[-1]]
-        rag_results = []
-
-        # Query RAG databases for relevant content
-        for database in self.rag_databases:
-            for message in relevant_messages:
-                rag_results.extend(database.query_text(message['content']))
 
+    def _append_rag_results(self, messages: list, rag_results: list) -> list[dict]:
         # If we have results, format and append to messages
         if rag_results:
             formatted_rag_content = "\n\n".join(
                 [f"#URL: {r.metadata['url']}\n{r.data}" for r in rag_results])
 
             messages[-1]['content'] += f"\n\nSOURCES{formatted_rag_content}"
-        
+
         return messages
 
 
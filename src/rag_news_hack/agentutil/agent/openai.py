@@ -1,5 +1,11 @@
-from openai import OpenAI
+import asyncio
+import threading
+import weakref
+from functools import lru_cache
 from typing import List, Dict
+
+from openai import AsyncOpenAI, OpenAI
+
 from ..ragstore import RAGDatabase
 from ..tool import BasicTool
 from .base import SimpleAgent
@@ -7,6 +13,27 @@ from .base import SimpleAgent
 from .. import SecretRetriever
 
 
+@lru_cache(maxsize=None)
+def _get_client(base_url: str, api_key: str) -> OpenAI:
+    # One client per endpoint, so its HTTP connection pool is reused between calls
+    return OpenAI(base_url=base_url, api_key=api_key)
+
+
+# The async client's connections are bound to the event loop that opened them, so we keep one per loop.
+# The loops are weak keys, so a closed loop (and its clients) can be collected
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+_async_clients_lock = threading.Lock()
+
+
+def _get_async_client(base_url: str, api_key: str, loop: asyncio.AbstractEventLoop) -> AsyncOpenAI:
+    with _async_clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get((base_url, api_key))
+        if client is None:
+            client = clients[(base_url, api_key)] = AsyncOpenAI(base_url=base_url, api_key=api_key)
+        return client
+
+
 class OpenAIAgent(SimpleAgent):
     def __init__(self, system_prompt: str = 'You are an Helpfull AI assistant.', rag_databases: list[RAGDatabase] = [], rag_on_all_messages: bool = True, model_name='gpt-4o-mini',  base_url=None, temperature: float = 0.8):
         super().__init__(system_prompt=system_prompt,
@@ -27,15 +54,19 @@ class OpenAIAgent(SimpleAgent):
             {"role": "system", "content": self.system_prompt}
         ] + messages
 
-        chat_input = self._retrieve_rag_information(chat_input)
+        # The RAG queries are independent, so we send them all at the same time.
+        # asyncio.run can not be used when an event loop is already running on this thread, then we query them one by one
+        if self.rag_databases:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                chat_input = asyncio.run(
+                    self._aretrieve_rag_information(chat_input))
+            else:
+                chat_input = self._retrieve_rag_information(chat_input)
 
-        if self.base_url:
-            client = OpenAI(
-                base_url=self.base_url,
-                api_key= SecretRetriever.get_secret('OPENAI_API_KEY')
-            )
-        else:
-            client = OpenAI(api_key= SecretRetriever.get_secret('OPENAI_API_KEY'))
+        client = _get_client(
+            self.base_url, SecretRetriever.get_secret('OPENAI_API_KEY'))
 
         response = client.chat.completions.create(
             model=self.model_name,
@@ -43,6 +74,33 @@ class OpenAIAgent(SimpleAgent):
             temperature=self.temperature,
         )
 
+        return self._response_to_completion(response)
+
+    async def achat_completion(self, messages: List[Dict[str, str]]) -> Dict:
+        """
+        Async version of chat_completion, to be used by callers that already run an event loop.
+
+        :param messages: A list of dictionaries with keys "role" and "content"
+        :return: A dictionary with the structure expected from the chat completions API
+        """
+        chat_input = [
+            {"role": "system", "content": self.system_prompt}
+        ] + messages
+
+        chat_input = await self._aretrieve_rag_information(chat_input)
+
+        client = _get_async_client(
+            self.base_url, SecretRetriever.get_secret('OPENAI_API_KEY'), asyncio.get_running_loop())
+
+        response = await client.chat.completions.create(
+            model=self.model_name,
+            messages=chat_input,
+            temperature=self.temperature,
+        )
+
+        return self._response_to_completion(response)
+
+    def _response_to_completion(self, response) -> Dict:
         # Extracting the necessary parts from the response
         message_content = response.choices[0].message.content
         finish_reason = response.choices[0].finish_reason
@@ -0,0 +1,2 @@
+from .proximity import ProximityCache
+from .lsh import LSHIndex, LSHProximityCache
\ No newline at end of file
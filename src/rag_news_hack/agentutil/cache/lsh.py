@@ -0,0 +1,145 @@
+from typing import Optional
+
+import numpy as np
+
+from .proximity import KEY_DTYPES, ProximityCache
+
+
+class LSHIndex:
+    """
+    A random-projection LSH index over cosine similarity.
+
+    Each table hashes a vector to the sign pattern of its projection on `bits` random hyperplanes,
+    so vectors with a small angle between them tend to land on the same bucket in at least one table.
+
+    Attributes:
+        dimension (int): The dimension of the indexed vectors.
+        num_tables (int): The number of hash tables.
+        bits (int): The number of hyperplanes (bits of the hash) per table.
+        dtype (str): The type used to store the projections, one of KEY_DTYPES.
+    """
+
+    def __init__(self, dimension: int, num_tables: int = 8, bits: int = 16, seed: Optional[int] = None, dtype: str = 'float32'):
+        """
+        Initializes the LSHIndex.
+
+        Args:
+            dimension (int): The dimension of the indexed vectors.
+            num_tables (int): The number of hash tables. Defaults to 8.
+            bits (int): The number of hyperplanes (bits of the hash) per table. Defaults to 16.
+            seed (Optional[int]): Seed for the random projections. Defaults to None.
+            dtype (str): The type used to store the projections, one of KEY_DTYPES. Defaults to 'float32'.
+        """
+        if dtype not in KEY_DTYPES:
+            raise ValueError(f'dtype must be one of {KEY_DTYPES}, got {dtype!r}')
+        self.dimension = dimension
+        self.num_tables = num_tables
+        self.bits = bits
+        self.dtype = dtype
+        rng = np.random.default_rng(seed)
+        # One (bits, dimension) projection matrix per table, stacked so all tables hash with one matmul
+        projections = rng.standard_normal((num_tables, bits, dimension))
+        if dtype == 'int8':
+            # Only the sign of the projection matters, so a single global scale is enough and can be dropped
+            projections = np.round(projections / np.abs(projections).max() * 127.0)
+        self.projections = projections.astype(dtype)
+        self.tables: list[dict[int, set[int]]] = [{} for _ in range(num_tables)]
+        # The hashes of each stored id, so it can be removed without rehashing
+        self._hashes: dict[int, list[int]] = {}
+
+    def hash(self, vector: np.ndarray) -> list[int]:
+        """
+        Computes the hash of a vector on each table.
+
+        Args:
+            vector (np.ndarray): The vector to hash.
+
+        Returns:
+            list[int]: One hash per table.
+        """
+        if self.dtype == 'float32':
+            projected = self.projections @ vector
+        else:
+            projected = np.einsum('tbd,d->tb', self.projections, vector, dtype=np.float32)
+        signs = projected > 0
+        packed = np.packbits(signs, axis=1)
+        return [int.from_bytes(row.tobytes(), 'big') for row in packed]
+
+    def add(self, id: int, vector: np.ndarray):
+        hashes = self.hash(vector)
+        self._hashes[id] = hashes
+        for table, h in zip(self.tables, hashes):
+            table.setdefault(h, set()).add(id)
+
+    def remove(self, id: int):
+        hashes = self._hashes.pop(id, None)
+        if hashes is None:
+            return
+        for table, h in zip(self.tables, hashes):
+            bucket = table[h]
+            bucket.discard(id)
+            if not bucket:
+                del table[h]
+
+    def candidates(self, vector: np.ndarray) -> set[int]:
+        """
+        Retrieves the ids that share a bucket with the vector on at least one table.
+
+        Args:
+            vector (np.ndarray): The vector to search for.
+
+        Returns:
+            set[int]: The candidate ids.
+        """
+        found: set[int] = set()
+        for table, h in zip(self.tables, self.hash(vector)):
+            found.update(table.get(h, ()))
+        return found
+
+
+class LSHProximityCache(ProximityCache):
+    """
+    A ProximityCache that finds the nearest key through an LSH index instead of a linear scan,
+    so lookups stay fast on large caches. Only the keys that collide with the query on some
+    table are rescored with the exact cosine distance.
+    """
+
+    def __init__(self, capacity: int = 1024, tau: float = 0.05, num_tables: int = 8, bits: int = 16, dtype: str = 'float32', ttl: Optional[float] = None):
+        """
+        Initializes the LSHProximityCache.
+
+        Args:
+            capacity (int): The maximum number of entries kept in the cache. Defaults to 1024.
+            tau (float): The maximum cosine distance for a stored key to be considered a hit. Defaults to 0.05.
+            num_tables (int): The number of LSH hash tables. Defaults to 8.
+            bits (int): The number of bits of the hash on each table. Defaults to 16.
+            dtype (str): The type used to store the keys and the LSH projections, one of KEY_DTYPES. Defaults to 'float32'.
+            ttl (Optional[float]): Seconds an entry stays valid. Defaults to None (entries never expire).
+        """
+        super().__init__(capacity=capacity, tau=tau, dtype=dtype, ttl=ttl)
+        self.num_tables = num_tables
+        self.bits = bits
+        self._index: Optional[LSHIndex] = None
+
+    def _nearest(self, q: np.ndarray) -> tuple[Optional[int], float]:
+        candidates = self._index.candidates(q)
+        if not candidates:
+            return None, float('inf')
+
+        slots = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        distances = 1.0 - self._similarities(slots, q)
+        best = int(np.argmin(distances))
+        return int(slots[best]), float(distances[best])
+
+    def _add(self, slot: int, key: np.ndarray):
+        if self._index is None:
+            self._index = LSHIndex(
+                key.size, num_tables=self.num_tables, bits=self.bits, dtype=self.dtype)
+        self._index.add(slot, key)
+
+    def _evict(self, slot: int):
+        self._index.remove(slot)
+
+    def _reset_index(self):
+        # Rebuilt on the next insert
+        self._index = None
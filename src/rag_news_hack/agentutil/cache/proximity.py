@@ -0,0 +1,194 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+
+# Supported types for the stored keys. float16 halves and int8 (with a per-row scale) quarters the memory of the keys
+KEY_DTYPES = ('float32', 'float16', 'int8')
+
+
+class ProximityCache:
+    """
+    A bounded, approximate key/value cache where the keys are embeddings.
+
+    A lookup is a hit when a stored key is within `tau` cosine distance of the queried embedding,
+    so near-duplicate queries share the same cached value. When the cache is full the least
+    recently used entry is evicted.
+
+    Attributes:
+        capacity (int): The maximum number of entries kept in the cache.
+        tau (float): The maximum cosine distance for a stored key to be considered a hit.
+        dtype (str): The type used to store the keys, one of KEY_DTYPES.
+        ttl (Optional[float]): Seconds an entry stays valid, or None if entries never expire.
+    """
+
+    def __init__(self, capacity: int = 1024, tau: float = 0.05, dtype: str = 'float32', ttl: Optional[float] = None):
+        """
+        Initializes the ProximityCache.
+
+        Args:
+            capacity (int): The maximum number of entries kept in the cache. Defaults to 1024.
+            tau (float): The maximum cosine distance for a stored key to be considered a hit. Defaults to 0.05.
+            dtype (str): The type used to store the keys, one of KEY_DTYPES. Defaults to 'float32'.
+            ttl (Optional[float]): Seconds an entry stays valid, so documents saved by other processes show up on repeated queries.
+                Defaults to None (entries never expire).
+        """
+        if dtype not in KEY_DTYPES:
+            raise ValueError(f'dtype must be one of {KEY_DTYPES}, got {dtype!r}')
+        self.capacity = capacity
+        self.tau = tau
+        self.dtype = dtype
+        self.ttl = ttl
+        # The keys are stored L2-normalized, one per row, so the cosine distance is just 1 - keys @ q.
+        # The matrix is allocated on the first insert, when we know the embedding dimension.
+        self._keys: Optional[np.ndarray] = None
+        # For int8 keys, the scale of each row (key ~= row * scale)
+        self._scales: Optional[np.ndarray] = None
+        self._values: list[Any] = []
+        # When each slot was inserted (time.monotonic), to expire them
+        self._inserted: list[float] = []
+        # Slots ordered from the least to the most recently used
+        self._lru: OrderedDict[int, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def lookup(self, embedding: list[float]) -> Optional[Any]:
+        """
+        Retrieves the value stored under the key closest to the given embedding.
+
+        Args:
+            embedding (list[float]): The embedding to look for.
+
+        Returns:
+            Optional[Any]: The cached value, or None if no key is within `tau` of the embedding.
+        """
+        q = self._normalize(embedding)
+        if q is None:
+            return None
+
+        with self._lock:
+            if not self._values:
+                return None
+
+            slot, distance = self._nearest(q)
+            if slot is None or distance > self.tau:
+                return None
+            if self.ttl is not None and time.monotonic() - self._inserted[slot] > self.ttl:
+                # Expired, the next insert for this query will replace it
+                return None
+
+            self._lru.move_to_end(slot)
+            return self._values[slot]
+
+    def insert(self, embedding: list[float], value: Any):
+        """
+        Stores a value under the given embedding, evicting the least recently used entry if the cache is full.
+
+        Args:
+            embedding (list[float]): The embedding used as key.
+            value (Any): The value to store.
+        """
+        q = self._normalize(embedding)
+        if q is None:
+            return
+
+        with self._lock:
+            if self._keys is None:
+                self._keys = np.empty((self.capacity, q.size), dtype=self.dtype)
+                if self.dtype == 'int8':
+                    self._scales = np.empty(self.capacity, dtype=np.float32)
+            elif self._values:
+                # The same query (an expired one, or a concurrent miss) only refreshes its entry
+                slot, distance = self._nearest(q)
+                if slot is not None and distance <= self.tau:
+                    self._values[slot] = value
+                    self._inserted[slot] = time.monotonic()
+                    self._lru.move_to_end(slot)
+                    return
+
+            if len(self._values) < self.capacity:
+                slot = len(self._values)
+                self._values.append(value)
+                self._inserted.append(time.monotonic())
+            else:
+                slot, _ = self._lru.popitem(last=False)
+                self._evict(slot)
+                self._values[slot] = value
+                self._inserted[slot] = time.monotonic()
+
+            self._set_key(slot, q)
+            self._lru[slot] = None
+            self._add(slot, q)
+
+    def clear(self):
+        """
+        Removes every entry from the cache, e.g. when the data behind the cached values changed.
+        """
+        with self._lock:
+            self._keys = None
+            self._scales = None
+            self._values = []
+            self._inserted = []
+            self._lru = OrderedDict()
+            self._reset_index()
+
+    def _set_key(self, slot: int, q: np.ndarray):
+        if self.dtype == 'int8':
+            # q is normalized, so its largest component is never 0
+            scale = np.abs(q).max() / 127.0
+            self._keys[slot] = np.round(q / scale)
+            self._scales[slot] = scale
+        else:
+            self._keys[slot] = q
+
+    def _similarities(self, rows, q: np.ndarray) -> np.ndarray:
+        """
+        Computes the cosine similarity between the query and the keys on the given rows.
+
+        Args:
+            rows: A slice or an array with the slots of the keys to compare.
+            q (np.ndarray): The normalized query, as float32.
+
+        Returns:
+            np.ndarray: The similarity with each key, as float32.
+        """
+        keys = self._keys[rows]
+        if self.dtype == 'float32':
+            return keys @ q
+        # BLAS only works on float32/float64. einsum reads the narrow keys directly,
+        # converting them on the fly instead of allocating a float32 copy of the whole matrix
+        similarities = np.einsum('ij,j->i', keys, q, dtype=np.float32)
+        if self.dtype == 'int8':
+            similarities *= self._scales[rows]
+        return similarities
+
+    def _nearest(self, q: np.ndarray) -> tuple[Optional[int], float]:
+        # Linear scan over every stored key with a single matrix-vector product
+        distances = 1.0 - self._similarities(slice(0, len(self._values)), q)
+        slot = int(np.argmin(distances))
+        return slot, float(distances[slot])
+
+    def _add(self, slot: int, key: np.ndarray):
+        # Hook for subclasses that keep an index over the keys
+        pass
+
+    def _evict(self, slot: int):
+        # Hook for subclasses that keep an index over the keys
+        pass
+
+    def _reset_index(self):
+        # Hook for subclasses that keep an index over the keys
+        pass
+
+    @staticmethod
+    def _normalize(embedding: list[float]) -> Optional[np.ndarray]:
+        q = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(q) if q.size else 0.0
+        # Failed embeddings come back empty, those can not be cached
+        if norm == 0.0:
+            return None
+        return q / norm
@@ -1,6 +1,13 @@
 from abc import ABC
+from typing import Iterable, Iterator
 
 class BaseChunk(ABC):    
     @staticmethod
     def split(text: str, chunk_chars_length: int = 1500) -> list[str]:
-        pass
\ No newline at end of file
+        pass
+
+    @classmethod
+    def split_batch(cls, texts: Iterable[str], chunk_chars_length: int = 1500) -> Iterator[list[str]]:
+        # Chunkers that can process several texts at once should override this
+        for text in texts:
+            yield cls.split(text, chunk_chars_length)
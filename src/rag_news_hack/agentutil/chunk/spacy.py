@@ -1,5 +1,8 @@
-from typing import List
+import os
+from functools import lru_cache
+from typing import Iterable, Iterator, List
 
+import numpy as np
 import spacy
 
 from .base import BaseChunk
@@ -11,40 +14,104 @@ from .base import BaseChunk
 #    return num_tokens
 
 
+SPACY_MODEL = "pt_core_news_sm"
+
+
+@lru_cache(maxsize=1)
+def _get_nlp():
+    # Only the sentence boundaries are used, so we skip loading every other component of the pipeline
+    exclude = ["parser", "ner", "morphologizer", "lemmatizer", "attribute_ruler"]
+    try:
+        nlp = spacy.load(SPACY_MODEL, exclude=exclude)
+    except OSError:
+        import pip
+        pip.main(['install', 'https://github.com/explosion/spacy-models/releases/download/pt_core_news_sm-3.7.0/pt_core_news_sm-3.7.0-py3-none-any.whl'])
+        nlp = spacy.load(SPACY_MODEL, exclude=exclude)
+
+    # Without the parser, sentences come from the (much lighter) senter, which ships disabled.
+    # If the model has none, fall back to the rule based sentencizer
+    if "senter" in nlp.disabled:
+        nlp.enable_pipe("senter")
+    elif "senter" not in nlp.pipe_names:
+        nlp.add_pipe("sentencizer")
+    return nlp
+
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is an optional dependency (the "jit" extra)
+    njit = None
+
+if njit is not None:
+    @njit(cache=True)
+    def _chunk_boundaries(lengths: np.ndarray, chunk_chars_length: int) -> np.ndarray:
+        """
+        Greedily groups consecutive sentences so each group has at most chunk_chars_length characters
+        (a single sentence longer than that becomes a group on its own).
+        Compiled to native code by numba, the compiled function is cached on disk.
+
+        :param lengths: The length of each sentence.
+        :param chunk_chars_length: The maximum number of characters in a chunk.
+        :return: The (exclusive) end index of each group of sentences.
+        """
+        boundaries = np.empty(lengths.size, np.int64)
+        n = 0
+        current = 0
+        for i in range(lengths.size):
+            if current + lengths[i] > chunk_chars_length and current > 0:
+                boundaries[n] = i
+                n += 1
+                current = 0
+            current += lengths[i]
+        if lengths.size > 0:
+            boundaries[n] = lengths.size
+            n += 1
+        return boundaries[:n]
+else:
+    def _chunk_boundaries(lengths: np.ndarray, chunk_chars_length: int) -> np.ndarray:
+        """
+        Greedily groups consecutive sentences so each group has at most chunk_chars_length characters
+        (a single sentence longer than that becomes a group on its own).
+
+        :param lengths: The length of each sentence.
+        :param chunk_chars_length: The maximum number of characters in a chunk.
+        :return: The (exclusive) end index of each group of sentences.
+        """
+        cumulative = np.cumsum(lengths, dtype=np.int64)
+        boundaries: List[int] = []
+        start = 0
+        while start < lengths.size:
+            offset = cumulative[start - 1] if start else 0
+            # Last sentence that still fits on the chunk started at `start`
+            end = int(np.searchsorted(cumulative, offset + chunk_chars_length, side='right'))
+            start = max(end, start + 1)
+            boundaries.append(start)
+        return np.array(boundaries, dtype=np.int64)
+
+
 class SpacyChunk(BaseChunk):
     @staticmethod
     def split(text: str, chunk_chars_length: int = 1500) -> list[str]:
-        # Load spaCy language model
-        try:
-            nlp = spacy.load("pt_core_news_sm")
-        except:
-            import pip
-            pip.main(['install', 'https://github.com/explosion/spacy-models/releases/download/pt_core_news_sm-3.7.0/pt_core_news_sm-3.7.0-py3-none-any.whl'])
-            nlp = spacy.load("pt_core_news_sm")
-
-        doc = nlp(text)
-        chunks: List[str] = []
-        current_chunk: List[str] = []
-        current_chunk_chars: int = 0
-
-        for sent in doc.sents:
-            sent_striped = sent.text.strip()
-            #lets ignore empty sentences
-            if sent_striped == '':
-                continue
-            # sent_tokens = num_tokens_from_string(sent.text)#len(nlp(sent.text))  # Count tokens in sentence
-            sent_chars = len(sent_striped)#len(nlp(sent_striped))
-            if current_chunk_chars + sent_chars > chunk_chars_length:
-                # Join sentences with space
-                chunks.append(" ".join(current_chunk))
-                current_chunk = []
-                current_chunk_chars = 0
-
-            current_chunk.append(sent_striped)
-            current_chunk_chars += sent_chars
-
-        # Add any remaining sentences
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
-
-        return chunks
+        # The spaCy language model is loaded only once
+        return SpacyChunk._chunk_doc(_get_nlp()(text), chunk_chars_length)
+
+    @staticmethod
+    def split_batch(texts: Iterable[str], chunk_chars_length: int = 1500, batch_size: int = 64) -> Iterator[list[str]]:
+        texts = list(texts)
+        # Only use extra processes when each one gets at least a full batch, otherwise starting them costs more than it saves
+        n_process = max(1, min(os.cpu_count() or 1, len(texts) // batch_size))
+        for doc in _get_nlp().pipe(texts, batch_size=batch_size, n_process=n_process):
+            yield SpacyChunk._chunk_doc(doc, chunk_chars_length)
+
+    @staticmethod
+    def _chunk_doc(doc, chunk_chars_length: int) -> list[str]:
+        # Strip each sentence once, and lets ignore the empty ones
+        sents = [text for text in (sent.text.strip() for sent in doc.sents) if text]
+        lengths = np.fromiter(map(len, sents), dtype=np.int32, count=len(sents))
+
+        boundaries = _chunk_boundaries(lengths, chunk_chars_length).tolist()
+
+        # Each chunk is the (start, end) slice of the sentences between two boundaries, joined with space
+        starts = [0] + boundaries[:-1]
+        return [" ".join(sents[a:b]) for a, b in zip(starts, boundaries)]
@@ -1,3 +1,4 @@
+import asyncio
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Optional, List
@@ -23,6 +24,10 @@ class BaseStore(ABC):
     def get_config(self, object_type: str, object_name: str) -> Optional[ConfigObject]:
         pass
 
+    async def aget_config(self, object_type: str, object_name: str) -> Optional[ConfigObject]:
+        # By default the blocking read runs on a worker thread, so several configs can be loaded at the same time
+        return await asyncio.to_thread(self.get_config, object_type, object_name)
+
     @abstractmethod
     def get_entities(self, object_type: str) ->  List[tuple[str, int]]:
         pass
\ No newline at end of file
@@ -1,18 +1,24 @@
 import os
-import json
 import time
 from typing import Optional, List
+
+import orjson
+
 from .base import BaseStore, ConfigObject
 
 class JSONStore(BaseStore):
     """
     A class to handle storage and retrieval of configuration objects in a directory as JSON files.
     Each file is named <type>_<name>.json, containing the instance, metadata, and created attributes.
+    An index.json file keeps the created timestamp of every object, so listing entities does not need to open every file.
+    When the store is opened, the index is rebuilt if the files changed behind its back (e.g. a git pull added a file).
 
     Attributes:
         directory (str): Path to the directory where JSON files are stored.
     """
 
+    INDEX_FILENAME = "index.json"
+
     def __init__(self, directory: str):
         """
         Initializes the JSONStore with the specified directory path.
@@ -23,6 +29,7 @@ class JSONStore(BaseStore):
         self.directory = directory
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
+        self._index: dict[str, dict[str, int]] = self._load_index()
 
     def initialize(self, overwrite: bool = False):
         """
@@ -36,6 +43,7 @@ class JSONStore(BaseStore):
                 file_path = os.path.join(self.directory, filename)
                 if os.path.isfile(file_path) and filename.endswith(".json"):
                     os.remove(file_path)
+            self._index = {}
 
     def store_config(self, obj: ConfigObject) -> ConfigObject:
         """
@@ -56,8 +64,12 @@ class JSONStore(BaseStore):
             "created": obj.created if obj.created else int(time.time())  # Use current time if not provided
         }
 
-        with open(filepath, 'w', 'utf-8') as f:
-            json.dump(data, f, indent=4)
+        # Serialize everything at once and write it with a single call
+        with open(filepath, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+        self._index.setdefault(obj.type, {})[obj.name] = data["created"]
+        self._write_index()
 
         return obj
 
@@ -76,8 +88,8 @@ class JSONStore(BaseStore):
         filepath = os.path.join(self.directory, filename)
 
         if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:                
-                data = json.load(f)
+            with open(filepath, 'rb') as f:
+                data = orjson.loads(f.read())
                 return ConfigObject(
                     type=object_type,
                     name=object_name,
@@ -89,7 +101,7 @@ class JSONStore(BaseStore):
 
     def get_entities(self, object_type: str) -> List[tuple[str, int]]:
         """
-        Retrieves all object names of the specified type from the directory.
+        Retrieves all object names of the specified type from the in-memory index, without touching the disk.
 
         Args:
             object_type (str): The type of the objects to retrieve.
@@ -97,12 +109,85 @@ class JSONStore(BaseStore):
         Returns:
             List[tuple[str, int]]: A list of tuples containing the object names and their created timestamps.
         """
-        entities = []
-        for filename in os.listdir(self.directory):
-            if filename.startswith(f"{object_type}_") and filename.endswith(".json"):
-                object_name = filename[len(object_type) + 1:-5]  # Remove type and ".json"
-                filepath = os.path.join(self.directory, filename)
-                with open(filepath, 'r') as f:
-                    data = json.load(f)
-                    entities.append((object_name, data['created']))
-        return entities
+        return list(self._index.get(object_type, {}).items())
+
+    def _list_files(self) -> dict[tuple[str, str], float]:
+        """
+        Lists the object files on the directory, without opening them.
+
+        Returns:
+            dict[tuple[str, str], float]: The modification time of each file, by type and name.
+        """
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name == self.INDEX_FILENAME or not entry.name.endswith(".json") or "_" not in entry.name:
+                    continue
+                object_type, object_name = entry.name[:-5].split("_", 1)  # Remove ".json" and split type and name
+                files[(object_type, object_name)] = entry.stat().st_mtime
+        return files
+
+    def _is_stale(self, index: dict[str, dict[str, int]]) -> bool:
+        """
+        Checks if the index file is missing, or does not match the object files on the directory
+        (a file was added or removed, or was written after the index).
+
+        Args:
+            index (dict[str, dict[str, int]]): The index to check.
+
+        Returns:
+            bool: True if the index must be rebuilt.
+        """
+        index_path = os.path.join(self.directory, self.INDEX_FILENAME)
+        try:
+            index_mtime = os.path.getmtime(index_path)
+        except FileNotFoundError:
+            return True
+
+        files = self._list_files()
+        indexed = {(object_type, object_name) for object_type, names in index.items() for object_name in names}
+        return indexed != files.keys() or any(mtime > index_mtime for mtime in files.values())
+
+    def _load_index(self) -> dict[str, dict[str, int]]:
+        """
+        Loads the index file. If it does not exist yet (a directory created before the index) or is stale,
+        builds it from the JSON files.
+
+        Returns:
+            dict[str, dict[str, int]]: The created timestamp of each object, by type and name.
+        """
+        index_path = os.path.join(self.directory, self.INDEX_FILENAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                index = orjson.loads(f.read())
+            if not self._is_stale(index):
+                return index
+
+        self._index = self._build_index()
+        self._write_index()
+        return self._index
+
+    def _build_index(self) -> dict[str, dict[str, int]]:
+        """
+        Builds the index reading the created timestamp of every JSON file.
+
+        Returns:
+            dict[str, dict[str, int]]: The created timestamp of each object, by type and name.
+        """
+        index: dict[str, dict[str, int]] = {}
+        for object_type, object_name in self._list_files():
+            filepath = os.path.join(self.directory, f"{object_type}_{object_name}.json")
+            with open(filepath, 'rb') as f:
+                data = orjson.loads(f.read())
+            index.setdefault(object_type, {})[object_name] = data['created']
+        return index
+
+    def _write_index(self):
+        """
+        Writes the index file atomically, so a reader never sees it half written.
+        """
+        index_path = os.path.join(self.directory, self.INDEX_FILENAME)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(self._index, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, index_path)
@@ -1,3 +1,4 @@
 from .base import BaseEmbedding
+from .cached import CachedEmbedding
 from .openai import OpenAIEmbedding
 #from .ollama import OllamaEmbedding
\ No newline at end of file
@@ -12,6 +12,16 @@ class BaseEmbedding:
         :return: A list representing the embedding of the input text.
         """
         raise NotImplementedError("Subclasses should implement this!")
+
+    def embed_batch(self, texts: list[str]) -> list[list]:
+        """
+        Get the embeddings of a list of texts. Subclasses that can embed several texts
+        in a single request should override this.
+
+        :param texts: The input texts to be embedded.
+        :return: A list with the embedding of each input text, in the same order.
+        """
+        return [self(text) for text in texts]
     
     #TODO: CHANGE THIS!!!
     def get_embedding_dimension(self) -> int:
@@ -0,0 +1,125 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Optional
+
+import numpy as np
+
+from .base import BaseEmbedding
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps another embedding and caches its results by the content of the text,
+    so identical texts are only embedded once.
+    The cache is kept in memory (up to max_items, least recently used first out, as float32 arrays) and,
+    if a path is given, also persisted on a SQLite file so it can be shared between runs (and processes).
+    The keys include the model of the wrapped embedding, so different models can share the same file.
+    """
+
+    def __init__(self, embedding: BaseEmbedding, path: Optional[str] = None, max_items: Optional[int] = None):
+        """
+        :param embedding: The embedding whose results will be cached.
+        :param path: Path of the SQLite file where the cache is persisted. If None, the cache is only kept in memory.
+        :param max_items: Maximum number of embeddings kept in memory. If None, there is no limit.
+        """
+        self.embedding = embedding
+        self.max_items = max_items
+        # Identifies the model, so its embeddings are not mixed with the ones from other models
+        self._model_id = f"{type(embedding).__qualname__}:{getattr(embedding, 'model', '')}"
+        # float32 arrays take 4 bytes per value, a list of python floats takes ~32
+        self._memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)')
+            self._db.commit()
+
+    def _key(self, text: str) -> str:
+        key = blake2b(self._model_id.encode('utf-8'), digest_size=16)
+        key.update(b'\0')
+        key.update(text.encode('utf-8'))
+        return key.hexdigest()
+
+    def _get(self, key: str, remember: bool = True) -> Optional[np.ndarray]:
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                return embedding
+
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                'SELECT embedding FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            embedding = np.frombuffer(row[0], dtype=np.float32)
+            if remember:
+                self._remember(key, embedding)
+            return embedding
+
+    def _put(self, items: dict[str, list], remember: bool = True) -> dict[str, np.ndarray]:
+        # Everything is converted (and returned) as float32, so a text gets the same vector from the cache or not
+        items = {k: np.asarray(e, dtype=np.float32) for k, e in items.items()}
+        # Failed embeddings come back empty, those must not be cached
+        valid = {k: e for k, e in items.items() if len(e)}
+        if valid:
+            with self._lock:
+                if remember:
+                    for k, e in valid.items():
+                        self._remember(k, e)
+                if self._db is not None:
+                    # Persisted as raw float32, 4 bytes per value
+                    self._db.executemany('INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)',
+                                         [(k, e.tobytes()) for k, e in valid.items()])
+                    self._db.commit()
+        return items
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        if self.max_items is not None and len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def __call__(self, text: str, remember: bool = True) -> list:
+        """
+        Get the embedding of a given text, from the cache if it was already calculated.
+
+        :param text: The input text to be embedded.
+        :param remember: If False a new embedding is not kept in memory (it is still persisted, if there is a path).
+            Used when indexing, as documents are rarely embedded twice and would only push the queries out of the cache.
+        :return: A list representing the embedding of the input text.
+        """
+        key = self._key(text)
+        embedding = self._get(key, remember)
+        if embedding is None:
+            embedding = self._put({key: self.embedding(text)}, remember)[key]
+        return embedding.tolist()
+
+    def embed_batch(self, texts: list[str], remember: bool = True) -> list[list]:
+        """
+        Get the embeddings of a list of texts. Only the texts that are not in the cache are sent,
+        in a single batch, to the wrapped embedding (repeated texts are sent only once).
+
+        :param texts: The input texts to be embedded.
+        :param remember: If False the new embeddings are not kept in memory (they are still persisted, if there is a path).
+        :return: A list with the embedding of each input text, in the same order.
+        """
+        keys = [self._key(text) for text in texts]
+        found = {}
+        for k in set(keys):
+            embedding = self._get(k, remember)
+            if embedding is not None:
+                found[k] = embedding.tolist()
+        misses = {k: text for k, text in zip(keys, texts) if k not in found}
+        if misses:
+            computed = self._put(dict(zip(misses.keys(), self.embedding.embed_batch(list(misses.values())))), remember)
+            found.update((k, e.tolist()) for k, e in computed.items())
+        return [found[k] for k in keys]
+
+    def get_embedding_dimension(self) -> int:
+        return self.embedding.get_embedding_dimension()
@@ -1,3 +1,5 @@
+from typing import Iterator
+
 from openai import OpenAI
 from .base import BaseEmbedding
 
@@ -6,13 +8,17 @@ class OpenAIEmbedding(BaseEmbedding):
     Class to get the embedding of a given text using an OpenAI embedding model.
     """
     
-    def __init__(self, model: str = 'text-embedding-ada-002'):
+    def __init__(self, model: str = 'text-embedding-ada-002', max_batch_items: int = 2048, max_batch_tokens: int = 8192):
         """
         Initialize the TextEmbedding class with a specific model.
         
         :param model: The embedding model to use, e.g., 'text-embedding-ada-002'.
+        :param max_batch_items: Maximum number of texts sent on a single call by embed_batch.
+        :param max_batch_tokens: Maximum (estimated) number of tokens sent on a single call by embed_batch.
         """
         self.model = model
+        self.max_batch_items = max_batch_items
+        self.max_batch_tokens = max_batch_tokens
     
     def __call__(self, text: str) -> list[float]:
         """
@@ -31,3 +37,38 @@ class OpenAIEmbedding(BaseEmbedding):
             print(f"An error occurred: {e}")
             return []
 
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        """
+        Get the embeddings of a list of texts, sending them to the OpenAI embedding model in as few calls as possible.
+        Each call has at most max_batch_items texts and (by an estimate) max_batch_tokens tokens.
+
+        :param texts: The input texts to be embedded.
+        :return: A list with the embedding of each input text, in the same order.
+        :raises openai.OpenAIError: If any of the calls fails.
+        """
+        if not texts:
+            return []
+        # Errors are raised (not turned into empty embeddings), so a failed batch is never saved without its vectors
+        client = OpenAI()
+
+        embeddings: list[list[float]] = []
+        for batch in self._sub_batches(texts):
+            response = client.embeddings.create(input=batch, model=self.model)
+            # The API may not return the items in order, so we sort them by their index
+            embeddings.extend(d.embedding for d in sorted(response.data, key=lambda d: d.index))
+        return embeddings
+
+    def _sub_batches(self, texts: list[str]) -> Iterator[list[str]]:
+        batch: list[str] = []
+        batch_tokens = 0
+        for text in texts:
+            # Roughly 4 characters per token, good enough to keep the request under the limits
+            tokens = len(text) // 4 + 1
+            if batch and (len(batch) >= self.max_batch_items or batch_tokens + tokens > self.max_batch_tokens):
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch
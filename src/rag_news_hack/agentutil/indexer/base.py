@@ -1,4 +1,5 @@
-from typing import Callable, Optional
+import asyncio
+from typing import Callable, Iterable, Iterator, Optional
 
 from ..chunk import BaseChunk
 from ..loader import DocLoader, LoadedData
@@ -12,35 +13,74 @@ class BaseIndexer:
                  chuncker: BaseChunk,
                  pre_chunker_handler: Optional[Callable[[
                      list[LoadedData]], list[LoadedData]]] = None,
-                 pos_chunker_handler: Optional[Callable[[list[LoadedData]], list[LoadedData]]] = None):
+                 pos_chunker_handler: Optional[Callable[[list[LoadedData]], list[LoadedData]]] = None,
+                 save_batch_size: int = 64):
         self.rag_store = rag_store
         self.loader = loader
         self.chunker = chuncker
         self.pre_chunker_handler = pre_chunker_handler
         self.pos_chunker_handler = pos_chunker_handler
+        self.save_batch_size = save_batch_size
 
     def index(self, source: str):
-        result = self.loader.load(source=source)        
+        result = self.loader.load(source=source)
 
+        # Chunks are saved in batches as they are produced, instead of keeping all of them in memory
+        self.rag_store.save_documents(((c.content, c.metadata) for batch in self._iter_batches(result) for c in batch),
+                                      batch_size=self.save_batch_size)
+
+    async def aindex(self, sources: list[str], max_concurrency: int = 8):
+        """
+        Index several sources concurrently, overlapping the loading, embedding and saving of the documents.
+
+        :param sources: The sources to index.
+        :param max_concurrency: Maximum number of sources being processed at the same time.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _index_one(source: str):
+            async with semaphore:
+                result = await self.loader.aload(source=source)
+                # Chunking is CPU bound, so it runs on a worker thread to not block the event loop
+                batches = await asyncio.to_thread(lambda: list(self._iter_batches(result)))
+                await asyncio.gather(*[self.rag_store.asave_texts([c.content for c in batch],
+                                                                  [c.metadata for c in batch])
+                                       for batch in batches])
+
+        await asyncio.gather(*[_index_one(s) for s in sources])
+
+    def _iter_batches(self, result: list[LoadedData]) -> Iterator[list[LoadedData]]:
         if self.pre_chunker_handler is not None:
             result = self.pre_chunker_handler(result)
 
-        for r in result:
-            content = r.content
-            metadata = r.metadata
-            chunks: list[LoadedData] = []
+        # Send every loaded document to the chunker at once, so it can process them in batch
+        if self.chunker:
+            splits = self.chunker.split_batch([r.content for r in result])
+        else:
+            splits = [None] * len(result)
 
-            if self.chunker:
-                splited_content = self.chunker.split(content)                
+        batch: list[LoadedData] = []
+        for c in self._iter_chunks(result, splits):
+            batch.append(c)
+            if len(batch) >= self.save_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _iter_chunks(self, result: list[LoadedData], splits: Iterable[Optional[list[str]]]) -> Iterator[LoadedData]:
+        for r, splited_content in zip(result, splits):
+            metadata = r.metadata
+            chunks: Iterable[LoadedData]
 
-                for s in splited_content:
-                    data = LoadedData(content=s, metadata=metadata)
-                    chunks.append(data)
+            if splited_content is not None:
+                chunks = (LoadedData(content=s, metadata=metadata)
+                          for s in splited_content)
             else:
                 chunks = [r]
 
             if self.pos_chunker_handler is not None:
-                chunks = self.pos_chunker_handler(chunks)
+                # The handler receives all the chunks of a document at once
+                chunks = self.pos_chunker_handler(list(chunks))
 
-            for c in chunks:                
-                self.rag_store.save_text(c.content, c.metadata)
+            yield from chunks
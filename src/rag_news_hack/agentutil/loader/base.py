@@ -1,3 +1,4 @@
+import asyncio
 from abc import ABC, abstractmethod
 
 from pydantic import BaseModel
@@ -12,3 +13,7 @@ class DocLoader(ABC):
     @abstractmethod
     def load(self, source, **kwargs) -> list[LoadedData]:
         pass
+
+    async def aload(self, source, **kwargs) -> list[LoadedData]:
+        # By default the blocking load runs on a worker thread
+        return await asyncio.to_thread(self.load, source, **kwargs)
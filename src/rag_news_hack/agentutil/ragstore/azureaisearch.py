@@ -1,11 +1,13 @@
-from copy import deepcopy
+import asyncio
+import random
 from json import loads
-from typing import List
+from typing import List, Optional
 from uuid import uuid4
 
+import numpy as np
 from azure.core.credentials import AzureKeyCredential
 from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
-from azure.search.documents import SearchClient
+from azure.search.documents import SearchClient, SearchIndexingBufferedSender
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (HnswAlgorithmConfiguration,
                                                    SearchableField,
@@ -16,17 +18,21 @@ from azure.search.documents.indexes.models import (HnswAlgorithmConfiguration,
                                                    VectorSearchProfile)
 from azure.search.documents.models import VectorizedQuery
 
+from ..cache import ProximityCache
 from ..embedding import BaseEmbedding
 from .base import RAGData, RAGDatabase
 from .. import SecretRetriever
 
+# Status codes (of the whole request or of a single document) that mean the service is throttling us
+THROTTLED_STATUS = (429, 503)
+
 
 class AzureSearchRAGDatabase(RAGDatabase):
     """
     A class that extends RAGDatabase and integrates Azure AI Search for document storage and retrieval.
     """
 
-    def __init__(self, service_name: str, index_name: str, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8):
+    def __init__(self, service_name: str, index_name: str, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8, query_cache: ProximityCache = None):
         """
         Initialize the AzureSearchRAGDatabase instance.
 
@@ -37,8 +43,9 @@ class AzureSearchRAGDatabase(RAGDatabase):
             embedding_function (BaseEmbedding): Embedding function for generating text embeddings.
             number_items_to_return (int): The number of items to return in a query. Defaults to 5.
             max_distance (float): The maximum distance to return similar items. Defaults to 0.8.
+            query_cache (ProximityCache): Cache for the results of near-duplicate queries. Defaults to None (no cache).
         """
-        super().__init__(embedding_function, number_items_to_return, max_distance)
+        super().__init__(embedding_function, number_items_to_return, max_distance, query_cache)
         self.service_name = service_name
         self.api_key = SecretRetriever.get_secret('AZ_AI_SEARCH_KEY')
         self.index_name = index_name
@@ -85,6 +92,10 @@ class AzureSearchRAGDatabase(RAGDatabase):
 
             self.index_client.create_or_update_index(index)
         finally:
+            # Names of the fields on the index, loaded when first needed
+            self._field_names: Optional[set[str]] = None
+            # The fields returned as metadata on the results (every field, but the text and the embedding)
+            self._user_fields: Optional[tuple[str, ...]] = None
             # And now get the client
             self.client = SearchClient(
                 endpoint=self.endpoint, index_name=self.index_name, credential=self.credentials)
@@ -92,26 +103,19 @@ class AzureSearchRAGDatabase(RAGDatabase):
     def reset_store(self):
         self.index_client.delete_index(self.index_name)
         self._create_index()
+        self._invalidate_query_cache()
 
-    def save_text(self, text: str, metadata: dict):
+    def save_text(self, text: str, metadata: dict, embedding: Optional[List[float]] = None):
         """
         Save the text and its corresponding embedding to Azure Search.
 
         Args:
             text (str): The text to be stored.
             metadata (dict): Additional metadata to be stored with the text.
+            embedding (Optional[List[float]]): The embedding of the text, if it was already calculated.
         """
 
-        # Lets copy all the metadata, since these will become "fields"
-        d: dict = deepcopy(metadata)
-        # And save the text and the embedding
-        d['data'] = text
-        d['embedding'] = self._calculate_embedding(text)
-        # If we have an ID make sure its a str
-        if 'id' in metadata:
-            d['id'] = str(metadata['id'])
-        else:
-            d['id'] = str(uuid4())
+        d = self._to_document(text, metadata, embedding if embedding is not None else self._calculate_embedding(text, remember=False))
 
         # Index the documents
         try:
@@ -123,6 +127,96 @@ class AzureSearchRAGDatabase(RAGDatabase):
                 result = self.client.merge_or_upload_documents(documents=[d])
             else:
                 raise e
+        self._invalidate_query_cache()
+
+    def save_texts(self, texts: List[str], metadatas: List[dict]):
+        """
+        Save several texts to Azure Search. The embeddings are calculated in a single batch and the documents
+        are uploaded by a SearchIndexingBufferedSender, which groups them in batches and retries the failed ones.
+        Raises a RuntimeError with the keys of the documents that still failed.
+
+        Args:
+            texts (List[str]): The texts to be stored.
+            metadatas (List[dict]): The metadata of each text, in the same order.
+        """
+        embeddings = self._calculate_embeddings(texts, remember=False)
+        documents = [self._to_document(t, m, e)
+                     for t, m, e in zip(texts, metadatas, embeddings)]
+
+        # The sender uploads in the background, so we can not create missing fields on error (as in save_text).
+        # Lets create them before sending the documents
+        self._ensure_fields(documents)
+
+        # The sender calls on_error (from its own thread) for each document that failed after its retries.
+        # Lets collect them and raise once the sender is closed, so a failed batch is not silently lost
+        failed = []
+        with SearchIndexingBufferedSender(endpoint=self.endpoint, index_name=self.index_name, credential=self.credentials,
+                                          on_error=failed.append) as sender:
+            sender.merge_or_upload_documents(documents=documents)
+        self._invalidate_query_cache()
+        if failed:
+            keys = [(action.additional_properties or {}).get('id') for action in failed]
+            raise RuntimeError(f"Failed to index {len(failed)} of {len(documents)} documents: {keys}")
+
+    async def asave_texts(self, texts: List[str], metadatas: List[dict], batch_size: int = 100, max_concurrency: int = 8):
+        """
+        Async version of save_texts. The documents are uploaded in batches, with up to max_concurrency
+        batches in flight at the same time. Throttled batches (or documents) are retried with exponential backoff,
+        any other failure raises.
+
+        Args:
+            texts (List[str]): The texts to be stored.
+            metadatas (List[dict]): The metadata of each text, in the same order.
+            batch_size (int): The number of documents on each upload. Defaults to 100.
+            max_concurrency (int): The maximum number of uploads running at the same time. Defaults to 8.
+        """
+        embeddings = await asyncio.to_thread(self._calculate_embeddings, texts, False)
+        documents = [self._to_document(t, m, e)
+                     for t, m, e in zip(texts, metadatas, embeddings)]
+        await asyncio.to_thread(self._ensure_fields, documents)
+
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _upload(batch: List[dict]):
+            async with semaphore:
+                await self._aupload_with_retry(batch)
+
+        await asyncio.gather(*[_upload(documents[i:i + batch_size])
+                               for i in range(0, len(documents), batch_size)])
+        self._invalidate_query_cache()
+
+    async def _aupload_with_retry(self, documents: List[dict], max_retries: int = 5):
+        delay = 1.0
+        pending = documents
+        for attempt in range(max_retries):
+            try:
+                # The sync client runs on a worker thread, the azure async client would need aiohttp
+                results = await asyncio.to_thread(self.client.merge_or_upload_documents, documents=pending)
+            except HttpResponseError as e:
+                # 503 (and 429) means the service is throttling us, anything else is a real error
+                if e.status_code not in THROTTLED_STATUS or attempt == max_retries - 1:
+                    raise
+            else:
+                # A 207 answer does not raise, each document has its own result. Only the throttled ones are retried
+                failed = [r for r in results if not r.succeeded]
+                if not failed:
+                    return
+                if attempt == max_retries - 1 or any(r.status_code not in THROTTLED_STATUS for r in failed):
+                    details = ', '.join(f'{r.key} ({r.status_code}: {r.error_message})' for r in failed)
+                    raise RuntimeError(f"Failed to index {len(failed)} of {len(pending)} documents: {details}")
+                failed_keys = {r.key for r in failed}
+                pending = [d for d in pending if d['id'] in failed_keys]
+            await asyncio.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 30.0)
+
+    def _to_document(self, text: str, metadata: dict, embedding: List[float]) -> dict:
+        # The metadata become "fields". A shallow copy is enough, we only add top level keys.
+        # And save the text, the embedding and make sure the ID is a str
+        d = {**metadata,
+             'data': text,
+             'embedding': embedding,
+             'id': str(metadata['id']) if 'id' in metadata else str(uuid4())}
+        return d
 
     def query_text(self, query_text: str) -> List[RAGData]:
         """
@@ -134,7 +228,26 @@ class AzureSearchRAGDatabase(RAGDatabase):
         Returns:
             List[RAGData]: A list of RAGData objects containing the matched text, similarity score, and metadata.
         """
-        search_embed = self._calculate_embedding(query_text)
+        return self.query_texts([query_text])[0]
+
+    def query_texts(self, query_texts: List[str]) -> List[List[RAGData]]:
+        """
+        Search for the most similar texts for each one of the query texts.
+        All the texts are embedded in a single call before searching.
+
+        Args:
+            query_texts (List[str]): The texts to search for.
+
+        Returns:
+            List[List[RAGData]]: One list of RAGData objects for each query text, in the same order.
+        """
+        query_embeddings = self._calculate_embeddings(query_texts)
+        return self._search_with_cache(query_texts, query_embeddings,
+                                       lambda texts, embeddings: self._search_each(texts, embeddings, self._search))
+
+    def _search(self, query_text: str, search_embed: List[float]) -> List[RAGData]:
+        # An exhaustive search, so the vector part of the hybrid query does not lose recall to the HNSW approximation.
+        # top is fixed, so a wider k would not return more rows anyway
         vector_query = VectorizedQuery(
             vector=search_embed,
             # kind='vector',
@@ -144,31 +257,36 @@ class AzureSearchRAGDatabase(RAGDatabase):
             weight=0.5
         )
 
-        # Perform search
+        # Perform search. Only the fields we use are returned
+        user_fields = self._get_user_fields()
         results = self.client.search(
             top=self.number_items_to_return,
             search_text=query_text,
-            vector_queries=[vector_query]
+            vector_queries=[vector_query],
+            select=[*user_fields, 'data', 'embedding']
         )
 
-        # Process results
-        rag_data_list = []
-        for result in results:
-            metadata = {}
-            for k, v in result.items():
-                if not (str(k).startswith('@')) and k != 'data':
-                    metadata[k] = v
-            rag_data = RAGData(
-                data=result['data'],
-                # as per https://learn.microsoft.com/en-us/azure/search/vector-search-ranking
-                # (1.0 - result['@search.score']) / result['@search.score'],
-                distance=result['@search.score'],
-                metadata=metadata
-            )
-            # Lets just consider elements that are not too far away
-            if rag_data.distance <= self.max_distance:
-                rag_data_list.append(rag_data)
-        return rag_data_list
+        # Process results. A row without a (full) embedding can not be scored, so it is skipped.
+        # It is only possible on documents saved by older versions, which stored failed embeddings as empty vectors
+        dimension = len(search_embed)
+        rows = [r for r in results if len(r.get('embedding') or ()) == dimension]
+        if not rows:
+            return []
+
+        # On a hybrid search @search.score is the RRF score (https://learn.microsoft.com/en-us/azure/search/vector-search-ranking),
+        # not a distance. So lets calculate the cosine distance from the returned embeddings, all rows in a single product
+        candidates = np.asarray([r['embedding'] for r in rows], dtype=np.float32)
+        candidates /= np.linalg.norm(candidates, axis=1, keepdims=True) + 1e-12
+        query = np.asarray(search_embed, dtype=np.float32)
+        query /= np.linalg.norm(query) + 1e-12
+        distances = 1.0 - candidates @ query
+        # Lets just consider elements that are not too far away, and only build those
+        keep = np.flatnonzero(distances <= self.max_distance)
+
+        return [RAGData(data=rows[i]['data'],
+                        distance=float(distances[i]),
+                        metadata={k: rows[i][k] for k in user_fields if k in rows[i]})
+                for i in keep]
 
     def get(self, attributes: dict = {}) -> List[RAGData]:
         """
@@ -203,12 +321,10 @@ class AzureSearchRAGDatabase(RAGDatabase):
             )
 
             # Process results
+            user_fields = self._get_user_fields()
             rag_data_list = []
             for result in results:
-                metadata = {}
-                for k, v in result.items():
-                    if not (str(k).startswith('@')) and k != 'data':
-                        metadata[k] = v
+                metadata = {k: result[k] for k in user_fields if k in result}
                 rag_data = RAGData(
                     data=result['data'],
                     distance=result['@search.score'],
@@ -229,6 +345,23 @@ class AzureSearchRAGDatabase(RAGDatabase):
         # No specific action needed to close Azure Search connection
         pass
 
+    def _get_field_names(self) -> set[str]:
+        if self._field_names is None:
+            self._field_names = {field.name for field in self.index_client.get_index(self.index_name).fields}
+        return self._field_names
+
+    def _get_user_fields(self) -> tuple[str, ...]:
+        if self._user_fields is None:
+            self._user_fields = tuple(name for name in self._get_field_names() if name not in ('data', 'embedding'))
+        return self._user_fields
+
+    def _ensure_fields(self, documents: List[dict]):
+        # Only go to the service when some document has a field we do not know about
+        known_fields = self._get_field_names()
+        missing = {k: v for d in documents for k, v in d.items() if k not in known_fields}
+        if missing:
+            self._update_fields(missing)
+
     def _update_fields(self, dictionary):
         # Get the current index schema
         current_index = self.index_client.get_index(self.index_name)
@@ -252,6 +385,8 @@ class AzureSearchRAGDatabase(RAGDatabase):
             current_index.fields.extend(new_fields)
             self.index_client.create_or_update_index(current_index)
             print("Index updated successfully!")
+            self._field_names = {field.name for field in current_index.fields}
+            self._user_fields = None
         else:
             print("No new fields to add.")
 
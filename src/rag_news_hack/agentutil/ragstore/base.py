@@ -1,6 +1,11 @@
+import asyncio
+import copy
 from abc import ABC, abstractmethod
-from typing import List, Any
-from ..embedding import BaseEmbedding
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Any, Optional, Tuple
+from ..cache import ProximityCache
+from ..embedding import BaseEmbedding, CachedEmbedding
 from dataclasses import dataclass
 
 @dataclass
@@ -17,6 +22,11 @@ class RAGData:
     distance: float
     metadata: dict
 
+def _chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
 class RAGDatabase(ABC):
     """
     An abstract base class for RAG (Retrieval-Augmented Generation) databases.
@@ -24,41 +34,127 @@ class RAGDatabase(ABC):
     This class provides a common interface for different RAG database implementations.
     """
 
-    def __init__(self, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8):
+    def __init__(self, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8, query_cache: Optional[ProximityCache] = None, embedding_cache_size: int = 1024):
         """
         Initialize the RAGDatabase instance.
 
         Args:
             embedding_function: A function that takes a text string as input and returns its embedding.
             number_items_to_return (int): The number of items to return in a query. Defaults to 5.
+            query_cache (ProximityCache): Cache for the results of near-duplicate queries. Defaults to None (no cache).
+            embedding_cache_size (int): How many query embeddings are kept in memory, so repeated queries are not embedded again.
+                Defaults to 1024 (~6 MB of float32 with 1536 dimensions). The embeddings of saved texts are not kept in memory.
+                To also persist them, pass a CachedEmbedding with a path as the embedding_function.
         """
+        if not isinstance(embedding_function, CachedEmbedding):
+            embedding_function = CachedEmbedding(embedding_function, max_items=embedding_cache_size)
         self.embedding_function = embedding_function
         self.number_items_to_return = number_items_to_return
         self.max_distance = max_distance
+        self.query_cache = query_cache
 
-    def _calculate_embedding(self, text: str) -> List[float]:
+    def _calculate_embedding(self, text: str, remember: bool = True) -> List[float]:
         """
         Calculate the embedding for the given text using the provided embedding function.
 
         Args:
             text (str): The text to embed.
+            remember (bool): If the embedding is kept on the in-memory cache. Write paths pass False. Defaults to True.
 
         Returns:
             List[float]: The embedding of the text.
         """
-        return self.embedding_function(text)
+        return self.embedding_function(text, remember=remember)
+
+    def _calculate_embeddings(self, texts: List[str], remember: bool = True) -> List[List[float]]:
+        """
+        Calculate the embeddings for a list of texts in a single call to the embedding function.
+
+        Args:
+            texts (List[str]): The texts to embed.
+            remember (bool): If the embeddings are kept on the in-memory cache. Write paths pass False. Defaults to True.
+
+        Returns:
+            List[List[float]]: The embeddings of the texts, in the same order.
+        """
+        return self.embedding_function.embed_batch(texts, remember=remember)
 
     @abstractmethod
-    def save_text(self, text: str, metadata: dict):
+    def save_text(self, text: str, metadata: dict, embedding: Optional[List[float]] = None):
         """
         Save the text and its corresponding embedding to the database.
 
         Args:
             text (str): The text to be stored.
             metadata (dict): Additional metadata to be stored with the text.
+            embedding (Optional[List[float]]): The embedding of the text, if it was already calculated.
         """
         pass
 
+    def save_texts(self, texts: List[str], metadatas: List[dict]):
+        """
+        Save several texts (and their embeddings) to the database.
+        The embeddings of all the texts are calculated in a single batch.
+        Backends that can insert a batch in a single request should override this.
+
+        Args:
+            texts (List[str]): The texts to be stored.
+            metadatas (List[dict]): The metadata of each text, in the same order.
+        """
+        embeddings = self._calculate_embeddings(texts, remember=False)
+        for text, metadata, embedding in zip(texts, metadatas, embeddings):
+            self.save_text(text, metadata, embedding=embedding)
+
+    def save_documents(self, documents: Iterable[Tuple[str, dict]], batch_size: int = 64, workers: int = 4):
+        """
+        Save a (possibly lazy) stream of documents. They are grouped in batches that are embedded and saved,
+        with save_texts, on a pool of threads, so the embedding of a batch overlaps with the saving of the others.
+        At most workers * 2 batches are in flight, so the documents are not all read into memory at once.
+
+        Args:
+            documents (Iterable[Tuple[str, dict]]): The (text, metadata) pairs to be stored.
+            batch_size (int): Number of documents on each batch. Defaults to 64.
+            workers (int): Number of batches saved at the same time. Defaults to 4.
+        """
+        batches = ((list(texts), list(metadatas))
+                   for texts, metadatas in (zip(*batch) for batch in _chunked(documents, batch_size)))
+        if workers <= 1:
+            for texts, metadatas in batches:
+                self.save_texts(texts, metadatas)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            in_flight = set()
+            for texts, metadatas in batches:
+                # Back pressure: wait for some batch to finish before reading more documents
+                if len(in_flight) >= workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                in_flight.add(executor.submit(self.save_texts, texts, metadatas))
+            for future in in_flight:
+                future.result()
+
+    async def asave_text(self, text: str, metadata: dict):
+        """
+        Async version of save_text. By default the blocking save runs on a worker thread.
+
+        Args:
+            text (str): The text to be stored.
+            metadata (dict): Additional metadata to be stored with the text.
+        """
+        await asyncio.to_thread(self.save_text, text, metadata)
+
+    async def asave_texts(self, texts: List[str], metadatas: List[dict]):
+        """
+        Async version of save_texts. By default the blocking save runs on a worker thread.
+
+        Args:
+            texts (List[str]): The texts to be stored.
+            metadatas (List[dict]): The metadata of each text, in the same order.
+        """
+        await asyncio.to_thread(self.save_texts, texts, metadatas)
+
     @abstractmethod
     def query_text(self, query_text: str) -> List[RAGData]:
         """
@@ -72,6 +168,136 @@ class RAGDatabase(ABC):
         """
         pass
 
+    async def aquery_text(self, query_text: str) -> List[RAGData]:
+        """
+        Async version of query_text. By default the blocking query runs on a worker thread,
+        so several databases (or several queries) can be awaited concurrently.
+
+        Args:
+            query_text (str): The text to search for.
+
+        Returns:
+            List[RAGData]: A list of RAGData objects containing the matched text, similarity score, and metadata.
+        """
+        return await asyncio.to_thread(self.query_text, query_text)
+
+    def query_texts(self, query_texts: List[str]) -> List[List[RAGData]]:
+        """
+        Search for the most similar texts for each one of the query texts.
+        Backends that can embed and search a batch in a single request should override this.
+
+        Args:
+            query_texts (List[str]): The texts to search for.
+
+        Returns:
+            List[List[RAGData]]: One list of RAGData objects for each query text, in the same order.
+        """
+        # Every query is embedded once, in a single batch, and the embedding is passed down to the search
+        return self._search_with_cache(query_texts,
+                                       self._calculate_embeddings(query_texts),
+                                       lambda texts, embeddings: self._search_each(texts, embeddings, self._query_embedding))
+
+    def _query_embedding(self, query_text: str, query_embedding: List[float]) -> List[RAGData]:
+        """
+        Search for the most similar texts using an embedding that was already calculated.
+        By default it falls back to query_text, backends should override it so the query is not embedded again.
+
+        Args:
+            query_text (str): The text to search for.
+            query_embedding (List[float]): The embedding of the text.
+
+        Returns:
+            List[RAGData]: A list of RAGData objects containing the matched text, similarity score, and metadata.
+        """
+        return self.query_text(query_text)
+
+    def _search_each(self,
+                     query_texts: List[str],
+                     query_embeddings: List[Any],
+                     search: Callable[[str, Any], List[RAGData]],
+                     max_workers: int = 16) -> List[List[RAGData]]:
+        """
+        Search each query on its own, for backends that can not search a batch in a single request.
+        The searches are network bound, so they run on a pool of threads instead of one after the other.
+
+        Args:
+            query_texts (List[str]): The texts to search for.
+            query_embeddings (List[Any]): The embeddings of the texts, in the same order.
+            search: A function that searches the database for a text and its embedding.
+            max_workers (int): Maximum number of searches running at the same time. Defaults to 16.
+
+        Returns:
+            List[List[RAGData]]: One list of RAGData objects for each query text, in the same order.
+        """
+        if len(query_texts) <= 1:
+            return [search(t, e) for t, e in zip(query_texts, query_embeddings)]
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(query_texts))) as executor:
+            return list(executor.map(search, query_texts, query_embeddings))
+
+    def _search_with_cache(self,
+                           query_texts: List[str],
+                           query_embeddings: List[List[float]],
+                           search: Callable[[List[str], List[List[float]]], List[List[RAGData]]]) -> List[List[RAGData]]:
+        """
+        Answer the queries from the query cache when possible, sending only the misses to the search function.
+
+        Args:
+            query_texts (List[str]): The texts to search for.
+            query_embeddings (List[List[float]]): The embeddings of the texts, in the same order.
+            search: A function that searches the database for a list of texts and their embeddings.
+
+        Returns:
+            List[List[RAGData]]: One list of RAGData objects for each query text, in the same order.
+        """
+        if self.query_cache is None:
+            return search(query_texts, query_embeddings)
+
+        results = [self.query_cache.lookup(e) for e in query_embeddings]
+        misses = [i for i, r in enumerate(results) if r is None]
+        if misses:
+            found = search([query_texts[i] for i in misses],
+                           [query_embeddings[i] for i in misses])
+            for i, result in zip(misses, found):
+                # An empty result is not cached, the documents may simply not have been indexed yet
+                if result:
+                    self.query_cache.insert(query_embeddings[i], result)
+                results[i] = result
+
+        # Return deep copies, so callers can not change the RAGData (or their metadata) that is in the cache
+        return copy.deepcopy(results)
+
+    def _invalidate_query_cache(self):
+        """
+        Drop every cached query result. Called after every write, so new documents show up on the next query.
+        """
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+    async def aquery_texts(self, query_texts: List[str]) -> List[List[RAGData]]:
+        """
+        Async version of query_texts. By default the blocking query runs on a worker thread.
+
+        Args:
+            query_texts (List[str]): The texts to search for.
+
+        Returns:
+            List[List[RAGData]]: One list of RAGData objects for each query text, in the same order.
+        """
+        return await asyncio.to_thread(self.query_texts, query_texts)
+
+    def exists_urls(self, urls: List[str]) -> set:
+        """
+        Check which of the given urls already have documents on the database.
+        By default each url is checked with get. Backends that can check all of them in a single request should override this.
+
+        Args:
+            urls (List[str]): The urls to check.
+
+        Returns:
+            set: The urls that are already on the database.
+        """
+        return {url for url in urls if self.get({'url': url})}
+
     @abstractmethod
     def get(self, attributes : dict = {}) -> List[RAGData]:
         """
@@ -1,23 +1,30 @@
-from pymongo import MongoClient, DESCENDING
+from pymongo import MongoClient, DESCENDING, UpdateOne
 from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
-from typing import List
+from typing import List, Optional
 from dataclasses import dataclass
+from ..cache import ProximityCache
 from ..embedding import BaseEmbedding
 from .base import RAGData, RAGDatabase
 
-from copy import deepcopy
+from functools import lru_cache
 from uuid import uuid4
 
 from .. import SecretRetriever
 
 
+@lru_cache(maxsize=None)
+def _get_client(connection_string: str) -> MongoClient:
+    # One client (and its connection pool) per cluster, shared by every instance that connects to it
+    return MongoClient(connection_string, maxPoolSize=64)
+
+
 class AzureCosmosMongoRAGDatabase(RAGDatabase):
     """
     A class that extends RAGDatabase and integrates Azure CosmosDB MongoDB for document storage and retrieval.
     """
 
-    def __init__(self, service_name: str, user: str, database_name: str, collection_name: str, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8):
+    def __init__(self, service_name: str, user: str, database_name: str, collection_name: str, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8, query_cache: ProximityCache = None):
         """
         Initialize the AzureCosmosMongoRAGDatabase instance.
 
@@ -28,12 +35,13 @@ class AzureCosmosMongoRAGDatabase(RAGDatabase):
             embedding_function (BaseEmbedding): Embedding function for generating text embeddings.
             number_items_to_return (int): The number of items to return in a query. Defaults to 5.
             max_distance (float): The maximum distance to return similar items. Defaults to 0.8.
+            query_cache (ProximityCache): Cache for the results of near-duplicate queries. Defaults to None (no cache).
         """
-        super().__init__(embedding_function, number_items_to_return, max_distance)
+        super().__init__(embedding_function, number_items_to_return, max_distance, query_cache)
         mongo_connection = 'mongodb+srv://{user}:{password}@{service_name}.mongocluster.cosmos.azure.com/?tls=true&authMechanism=SCRAM-SHA-256&retrywrites=false&maxIdleTimeMS=120000'
         mongo_connection = mongo_connection.format(user=user, service_name=service_name, password=SecretRetriever.get_secret('AZ_COSMOS_MONGO_PWD'))
 
-        self.client = MongoClient(mongo_connection)
+        self.client = _get_client(mongo_connection)
         self.database_name = database_name
         self.db = self.client[database_name]
         self.collection_name = collection_name
@@ -65,28 +73,53 @@ class AzureCosmosMongoRAGDatabase(RAGDatabase):
             ]
         })
 
-    def save_text(self, text: str, metadata: dict):
+    def save_text(self, text: str, metadata: dict, embedding: Optional[List[float]] = None):
         """
         Save the text and its corresponding embedding to CosmosDB MongoDB.
 
         Args:
             text (str): The text to be stored.
             metadata (dict): Additional metadata to be stored with the text.
+            embedding (Optional[List[float]]): The embedding of the text, if it was already calculated.
         """
-        embedding = self._calculate_embedding(text)
-        meta = deepcopy(metadata)
-        meta['id'] = str(metadata.get('id', uuid4()))
-        document = {
-            "data": text,
-            "embedding": embedding,
-            "metadata": meta
-        }
+        if embedding is None:
+            embedding = self._calculate_embedding(text, remember=False)
+        document = self._to_document(text, metadata, embedding)
         try:
             self.collection.insert_one(document)
         except DuplicateKeyError:
             # If a document with the same id exists, update it
             self.collection.update_one(
-                {"metadata.id": meta.get('id')}, {"$set": document})
+                {"metadata.id": document['metadata']['id']}, {"$set": document})
+        self._invalidate_query_cache()
+
+    def save_texts(self, texts: List[str], metadatas: List[dict]):
+        """
+        Save several texts to CosmosDB MongoDB, calculating their embeddings in a single batch
+        and upserting all the documents with a single bulk write.
+
+        Args:
+            texts (List[str]): The texts to be stored.
+            metadatas (List[dict]): The metadata of each text, in the same order.
+        """
+        embeddings = self._calculate_embeddings(texts, remember=False)
+        operations = []
+        for text, metadata, embedding in zip(texts, metadatas, embeddings):
+            document = self._to_document(text, metadata, embedding)
+            operations.append(UpdateOne({"metadata.id": document['metadata']['id']},
+                                        {"$set": document}, upsert=True))
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+        self._invalidate_query_cache()
+
+    def _to_document(self, text: str, metadata: dict, embedding: List[float]) -> dict:
+        # A shallow copy is enough, we only replace the id
+        meta = {**metadata, 'id': str(metadata.get('id', uuid4()))}
+        return {
+            "data": text,
+            "embedding": embedding,
+            "metadata": meta
+        }
 
     def query_text(self, query_text: str) -> List[RAGData]:
         """
@@ -98,18 +131,32 @@ class AzureCosmosMongoRAGDatabase(RAGDatabase):
         Returns:
             List[RAGData]: A list of RAGData objects containing the matched text, similarity score, and metadata.
         """
-        query_embedding = self._calculate_embedding(query_text)
+        return self._query_embedding(query_text, self._calculate_embedding(query_text))
 
-        # Perform the vector similarity search (cosine similarity or other metrics)
+    def _query_embedding(self, query_text: str, query_embedding: List[float]) -> List[RAGData]:
+        # Perform the vector similarity search. The index uses the cosine similarity (COS),
+        # so the distance is 1 - score, and we only keep what is within max_distance
         pipeline = [
             {
                 "$search": {
-                    "knnBeta": {
+                    "cosmosSearch": {
                         "vector": query_embedding,
                         "path": "embedding",
                         "k": self.number_items_to_return
-                    }
+                    },
+                    "returnStoredSource": True
                 }
+            },
+            {
+                "$project": {
+                    "_id": 0,
+                    "data": 1,
+                    "metadata": 1,
+                    "score": {"$meta": "searchScore"}
+                }
+            },
+            {
+                "$match": {"score": {"$gte": 1 - self.max_distance}}
             }
         ]
 
@@ -119,7 +166,7 @@ class AzureCosmosMongoRAGDatabase(RAGDatabase):
         for result in results:
             rag_data = RAGData(
                 data=result["data"],
-                distance=0,  # MongoDB does not calculate distance by default, you might need to implement this
+                distance=1 - result["score"],
                 metadata=result["metadata"]
             )
             rag_data_list.append(rag_data)
@@ -151,8 +198,22 @@ class AzureCosmosMongoRAGDatabase(RAGDatabase):
 
         return rag_data_list
 
+    def exists_urls(self, urls: List[str]) -> set:
+        """
+        Check, in a single query, which of the given urls already have documents on CosmosDB MongoDB.
+
+        Args:
+            urls (List[str]): The urls to check.
+
+        Returns:
+            set: The urls that are already on the database.
+        """
+        if not urls:
+            return set()
+        return set(self.collection.distinct("metadata.url", {"metadata.url": {"$in": list(urls)}}))
+
     def close(self):
         """
-        Close the database connection.
+        Nothing to close, the client is shared with the other instances that use the same cluster.
         """
-        self.client.close()
+        pass
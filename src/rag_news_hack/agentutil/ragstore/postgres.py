@@ -1,19 +1,120 @@
-import psycopg2
-from psycopg2.extras import Json
-from typing import List
+import threading
+import weakref
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterator, List, Optional
 from uuid import uuid4
-from pgvector.utils import Vector
+
+import numpy as np
+import orjson
+from psycopg2.extensions import connection
+from psycopg2.extras import Json, execute_values, register_default_jsonb
+from psycopg2.pool import ThreadedConnectionPool
+from pgvector.psycopg2 import register_vector
 
 from .base import RAGData, RAGDatabase
+from ..cache import ProximityCache
 from ..embedding import BaseEmbedding
 
 
+class _BlockingConnectionPool(ThreadedConnectionPool):
+    """
+    A ThreadedConnectionPool that waits for a connection to be returned when all of them are in use,
+    instead of raising PoolError, so many threads (indexers, searches) can share a small pool.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        self._slots.acquire()
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+
+@lru_cache(maxsize=None)
+def _get_pool(db_name: str, user: str, password: str, host: str, port: int) -> ThreadedConnectionPool:
+    # One pool per database, shared by every instance that connects to it
+    return _BlockingConnectionPool(1, 16, dbname=db_name, user=user, password=password, host=host, port=port)
+
+
+# Pooled connections that were already set up (vector and jsonb types registered and statements prepared)
+_ready_connections: "weakref.WeakSet[connection]" = weakref.WeakSet()
+
+
+# Supported types for the embedding column. halfvec needs pgvector 0.7 or newer
+EMBEDDING_TYPES = ('vector', 'halfvec')
+
+
+def _json_dumps(obj) -> str:
+    # orjson is a lot faster than the json module psycopg2 uses by default
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    # Unit vectors, so the inner product is the cosine similarity (and the norms are not calculated on every comparison)
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return embedding / (np.linalg.norm(embedding) + 1e-12)
+
+
 class PostgresPgVectorRAGDatabase(RAGDatabase):
     """
     A class that extends RAGDatabase and integrates PostgreSQL with pgvector for document storage and retrieval.
     """
 
-    def __init__(self, db_name: str, user: str, password: str, host: str, port: int, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8):
+    # The hybrid search, run once for each (query text, embedding) pair of the batch.
+    # Its parameters are: $1 the query texts, $2 the query embeddings, $3 the max distance,
+    # $4 the number of items on each search, $5 the RRF k constant, $6 the number of items to return.
+    # It is prepared once per connection, so it is not parsed and planned again on every query.
+    # The embeddings are stored normalized, so we use the inner product (<#>, that returns the negative of the product)
+    # and the cosine distance is 1 + (embedding <#> q.emb).
+    # {embedding_type} is replaced by the type of the embedding column
+    HYBRID_QUERY = """
+    SELECT q.idx, h.id, h.data, h.metadata, h.distance
+    FROM unnest($1::text[], $2::{embedding_type}[]) WITH ORDINALITY AS q(query_text, emb, idx)
+    CROSS JOIN LATERAL (
+        SELECT
+            coalesce(vector_search.id, fulltext_search.id) as id,
+            coalesce(vector_search.data, fulltext_search.data) as data,
+            coalesce(vector_search.metadata, fulltext_search.metadata) as metadata,
+            coalesce(vector_search.distance, fulltext_search.distance) as distance,
+            COALESCE(1.0 / ($5 + vector_search.rank), 0.0) + COALESCE(1.0 / ($5 + fulltext_search.rank), 0.0) as score
+        FROM (
+            -- Vector similarity search using pgvector. The distance is calculated once per row, on the inner query
+            SELECT id, data, metadata, distance, row_number() OVER (ORDER BY distance) as rank
+            FROM (
+                SELECT id, data, metadata, 1 + (embedding <#> q.emb) as distance
+                FROM rag_data
+                ORDER BY embedding <#> q.emb
+                LIMIT $4
+            ) nearest
+            WHERE distance <= $3
+        ) vector_search
+        FULL OUTER JOIN (
+            -- Full text search. The distance is only calculated for the few rows that matched
+            SELECT id, data, metadata, 1 + (embedding <#> q.emb) as distance, RANK () OVER (ORDER BY ts_rank_cd(data_tsv, query) DESC) as rank
+            FROM rag_data, plainto_tsquery('english', q.query_text ) query
+            WHERE data_tsv @@ query
+            ORDER BY ts_rank_cd(data_tsv, query) DESC
+            LIMIT $4
+        ) fulltext_search ON vector_search.id = fulltext_search.id
+        ORDER BY score DESC
+        LIMIT $6
+    ) h
+    ORDER BY q.idx, h.score DESC
+    """
+
+    def __init__(self, db_name: str, user: str, password: str, host: str, port: int, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8, query_cache: ProximityCache = None, embedding_type: str = 'vector'):
         """
         Initialize the PostgresPgVectorRAGDatabase instance.
 
@@ -26,69 +127,137 @@ class PostgresPgVectorRAGDatabase(RAGDatabase):
             embedding_function (BaseEmbedding): Embedding function for generating text embeddings.
             number_items_to_return (int): The number of items to return in a query. Defaults to 5.
             max_distance (float): The maximum distance to return similar items. Defaults to 0.8.
+            query_cache (ProximityCache): Cache for the results of near-duplicate queries. Defaults to None (no cache).
+            embedding_type (str): The type of the embedding column, 'vector' (float32) or 'halfvec' (float16, half the size).
+                Changing it on an existing store requires a reset_store. Defaults to 'vector'.
         """
-        super().__init__(embedding_function, number_items_to_return, max_distance)
-        self.connection = psycopg2.connect(
-            dbname=db_name,
-            user=user,
-            password=password,
-            host=host,
-            port=port
-        )
-        self.cursor = self.connection.cursor()
+        if embedding_type not in EMBEDDING_TYPES:
+            raise ValueError(f'embedding_type must be one of {EMBEDDING_TYPES}, got {embedding_type!r}')
+        super().__init__(embedding_function, number_items_to_return, max_distance, query_cache)
+        self.embedding_type = embedding_type
+        self.pool = _get_pool(db_name, user, password, host, port)
         self._create_table()
 
+    @contextmanager
+    def _connection(self, setup: bool = True) -> Iterator[connection]:
+        """
+        Borrow a connection from the pool. The transaction is committed when the block ends (or rolled back on error)
+        and the connection goes back to the pool.
+
+        Args:
+            setup (bool): Whether the connection must be ready for the queries. Defaults to True.
+        """
+        conn = self.pool.getconn()
+        try:
+            if setup and conn not in _ready_connections:
+                # Lets psycopg2 send numpy arrays as vectors, without formatting them as python lists
+                register_vector(conn)
+                # And the jsonb values (the metadata) are decoded with orjson
+                register_default_jsonb(conn_or_curs=conn, loads=orjson.loads)
+                self._prepare_statements(conn)
+                _ready_connections.add(conn)
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
     def _create_table(self):
         """
         Create the table for storing text, embeddings, and metadata if it doesn't exist.
         """
-        create_table_query = """
+        create_table_query = f"""
         CREATE TABLE IF NOT EXISTS rag_data (
             id UUID PRIMARY KEY,
             data TEXT,
-            embedding VECTOR(%s),  -- Adjust to match your embedding dimensions
+            embedding {self.embedding_type}(%s),  -- Adjust to match your embedding dimensions
             metadata JSONB
         );
+        -- The text search vector is calculated once, when the row is written. Adding it also fills the existing rows
+        ALTER TABLE rag_data ADD COLUMN IF NOT EXISTS data_tsv tsvector GENERATED ALWAYS AS (to_tsvector('english', data)) STORED;
         """
         embedding_dimension = self.embedding_function.get_embedding_dimension()
-        self.cursor.execute(create_table_query, (embedding_dimension,))
-        self.connection.commit()
+
+        # HNSW index (inner product, the embeddings are normalized) for the vector search,
+        # and GIN indexes for the full text search and the metadata filters
+        create_indexes_query = f"""
+        CREATE INDEX IF NOT EXISTS rag_data_emb_hnsw_ip ON rag_data USING hnsw (embedding {self.embedding_type}_ip_ops) WITH (m = 16, ef_construction = 200);
+        CREATE INDEX IF NOT EXISTS rag_data_tsv_gin ON rag_data USING GIN (data_tsv);
+        CREATE INDEX IF NOT EXISTS rag_data_md_gin ON rag_data USING GIN (metadata jsonb_path_ops);
+        """
+        with self._connection(setup=False) as conn, conn.cursor() as cursor:
+            cursor.execute(create_table_query, (embedding_dimension,))
+            cursor.execute(create_indexes_query)
+
+    def _prepare_statements(self, conn: connection):
+        """
+        Prepare the statements used on the queries. Prepared statements live on the connection (session).
+        """
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"PREPARE rag_hybrid (text[], {self.embedding_type}[], float, int, int, int) AS {self.HYBRID_QUERY.format(embedding_type=self.embedding_type)};")
+        conn.commit()
 
     def reset_store(self):
         """
         Drop and recreate the table to reset the store.
         """
         drop_table_query = "DROP TABLE IF EXISTS rag_data;"
-        self.cursor.execute(drop_table_query)
+        with self._connection(setup=False) as conn, conn.cursor() as cursor:
+            cursor.execute(drop_table_query)
         self._create_table()
+        self._invalidate_query_cache()
 
-    def save_text(self, text: str, metadata: dict):
+    def save_text(self, text: str, metadata: dict, embedding: Optional[List[float]] = None):
         """
         Save the text and its corresponding embedding to PostgreSQL with pgvector.
 
         Args:
             text (str): The text to be stored.
             metadata (dict): Additional metadata to be stored with the text.
+            embedding (Optional[List[float]]): The embedding of the text, if it was already calculated.
         """
         # Generate embedding
-        embedding = self._calculate_embedding(text)
+        if embedding is None:
+            embedding = self._calculate_embedding(text, remember=False)
 
-        # Convert the list of embedding values into a string for the query
-        embedding_str = str(embedding)
+        self._upsert([self._to_row(text, metadata, embedding)])
 
+    def save_texts(self, texts: List[str], metadatas: List[dict]):
+        """
+        Save several texts to PostgreSQL with pgvector. The embeddings are calculated in a single batch
+        and the rows are inserted with multi-row statements, in a single transaction.
+
+        Args:
+            texts (List[str]): The texts to be stored.
+            metadatas (List[dict]): The metadata of each text, in the same order.
+        """
+        embeddings = self._calculate_embeddings(texts, remember=False)
+        self._upsert([self._to_row(t, m, e)
+                      for t, m, e in zip(texts, metadatas, embeddings)])
+
+    def _to_row(self, text: str, metadata: dict, embedding: List[float]) -> tuple:
         # Generate UUID if not present
-        id_value = str(metadata.get('id', uuid4()))
+        return (str(metadata.get('id', uuid4())), text, _normalize(embedding), Json(metadata, dumps=_json_dumps))
+
+    def _upsert(self, rows: List[tuple]):
+        if not rows:
+            return
+        # A statement can not update the same row twice, so if an id repeats only its last row is kept
+        rows = list({row[0]: row for row in rows}.values())
 
-        # Insert into the database
         insert_query = """
         INSERT INTO rag_data (id, data, embedding, metadata)
-        VALUES (%s, %s, %s, %s)
+        VALUES %s
         ON CONFLICT (id) DO UPDATE 
         SET data = EXCLUDED.data, embedding = EXCLUDED.embedding, metadata = EXCLUDED.metadata;
         """
-        self.cursor.execute(
-            insert_query, (id_value, text, embedding_str, Json(metadata)))
-        self.connection.commit()
+        # execute_values sends up to page_size rows on each INSERT, all of them on a single transaction
+        with self._connection() as conn, conn.cursor() as cursor:
+            execute_values(cursor, insert_query, rows, page_size=500)
+        self._invalidate_query_cache()
 
     def query_text(self, query_text: str) -> List[RAGData]:
         """
@@ -100,66 +269,55 @@ class PostgresPgVectorRAGDatabase(RAGDatabase):
         Returns:
             List[RAGData]: A list of RAGData objects containing the matched text, similarity score, and metadata.
         """
-        # Generate query embedding
-        query_embedding = self._calculate_embedding(query_text)
-
-        # Convert the list of embedding values into a string for the query
-        query_embedding_str = str(query_embedding)
-
-        # Perform the vector similarity search using pgvector and casting the array to the vector type
-        vector_query = f"""
-        SELECT id, data, metadata, rank() over (ORDER BY embedding <=> %(emb)s ) as rank
-        FROM rag_data
-        where (embedding <=> %(emb)s) <= %(max_distance)s
-        ORDER BY  embedding <=> %(emb)s
-        LIMIT %(double_nitens)s
-        """
-
-        fulltext_query = f"""
-           SELECT id, data, metadata, RANK () OVER (ORDER BY ts_rank_cd(to_tsvector('english', data), query) DESC) as rank
-                FROM rag_data, plainto_tsquery('english', %(query_text)s ) query
-                WHERE query @@ to_tsvector('english', data)
-                ORDER BY ts_rank_cd(to_tsvector('english', data), query) DESC
-                LIMIT %(double_nitens)s
-            """
-
-        hybrid_query = f"""
-        WITH vector_search AS (
-            {vector_query}
-        ),
-        fulltext_search AS (
-            {fulltext_query}
-        )
-        SELECT
-            coalesce(vector_search.id, fulltext_search.id) as id,
-            coalesce(vector_search.data, fulltext_search.data) as data,
-            coalesce(vector_search.metadata, fulltext_search.metadata) as metadata
-        FROM vector_search
-        FULL OUTER JOIN fulltext_search ON vector_search.id = fulltext_search.id
-        ORDER BY COALESCE(1.0 / (%(k)s + vector_search.rank), 0.0) + COALESCE(1.0 / (%(k)s + fulltext_search.rank), 0.0) DESC
-        LIMIT %(nitens)s
+        return self.query_texts([query_text])[0]
+
+    def query_texts(self, query_texts: List[str]) -> List[List[RAGData]]:
         """
+        Search for the most similar texts for each one of the query texts. All the texts are embedded
+        in a single call and searched with a single SQL statement.
 
-        self.cursor.execute(hybrid_query, {'max_distance': self.max_distance,
-                            'emb': query_embedding_str, 'query_text': query_text, 'double_nitens': self.number_items_to_return * 2, 'nitens': self.number_items_to_return, 'k': 60})
-        results = self.cursor.fetchall()
+        Args:
+            query_texts (List[str]): The texts to search for.
 
-        # Process and return results
-        rag_data_list = []
+        Returns:
+            List[List[RAGData]]: One list of RAGData objects for each query text, in the same order.
+        """
+        if not query_texts:
+            return []
+
+        # Generate the query embeddings all at once
+        query_embeddings = self._calculate_embeddings(query_texts)
+
+        return self._search_with_cache(query_texts, query_embeddings, self._hybrid_search)
+
+    def _hybrid_search(self, query_texts: List[str], query_embeddings: List[List[float]]) -> List[List[RAGData]]:
+        query_embeddings_np = [_normalize(e) for e in query_embeddings]
+        # The HNSW scan returns at most ef_search candidates, so it is never below the number of rows the vector branch
+        # asks for (number_items_to_return * 2). With that the scan is not the cap, and when few rows pass max_distance
+        # searching again with a larger ef_search does not help: the rows it got are already the nearest ones
+        ef_search = max(self.number_items_to_return * 2, 40)
+        return self._run_hybrid(ef_search, query_texts, query_embeddings_np)
+
+    def _run_hybrid(self, ef_search: int, query_texts: List[str], query_embeddings: List[np.ndarray]) -> List[List[RAGData]]:
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute(f"SET LOCAL hnsw.ef_search = %s; EXECUTE rag_hybrid(%s, %s::{self.embedding_type}[], %s, %s, %s, %s);",
+                           (ef_search, query_texts, query_embeddings, self.max_distance, self.number_items_to_return * 2, 60, self.number_items_to_return))
+            results = cursor.fetchall()
+
+        # Process and return results, grouped by query text
+        rag_data_lists: List[List[RAGData]] = [[] for _ in query_texts]
         for result in results:
-            id, data, metadata = result
+            idx, id, data, metadata, distance = result
             metadata['id'] = id
-            # print(data, distance)
-            # print('---')
             rag_data = RAGData(
                 data=data,
-                distance=0,
+                distance=distance,
                 metadata=metadata
             )
             if rag_data.distance <= self.max_distance:
-                rag_data_list.append(rag_data)
+                rag_data_lists[idx - 1].append(rag_data)
 
-        return rag_data_list
+        return rag_data_lists
 
     def get(self, attributes: dict = {}) -> List[RAGData]:
         """
@@ -171,35 +329,43 @@ class PostgresPgVectorRAGDatabase(RAGDatabase):
         Returns:
             List[RAGData]: A list of RAGData objects containing the matched text, similarity score, and metadata.
         """
-        filters = []
-        values = []
+        # The whole filter goes as a single parameter, matched by containment (uses the GIN index on metadata)
+        query = "SELECT data, metadata FROM rag_data WHERE metadata @> %s::jsonb LIMIT %s;"
 
-        # Build SQL query filters based on the attributes
-        for key, value in attributes.items():
-            filters.append(f"metadata->>'{key}' = %s")
-            values.append(value)
-
-        # Create the query string
-        filter_query = " AND ".join(filters) if filters else "TRUE"
-        query = f"SELECT data, metadata FROM rag_data WHERE {filter_query} LIMIT %s;"
-        self.cursor.execute(query, (*values, self.number_items_to_return))
-        results = self.cursor.fetchall()
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (Json(attributes, dumps=_json_dumps), self.number_items_to_return))
+            results = cursor.fetchall()
 
         # Process and return results
-        rag_data_list = []
-        for result in results:
-            data, metadata = result
-            rag_data = RAGData(
-                data=data,
-                distance=0,  # No distance for get operation
-                metadata=metadata
-            )
-            rag_data_list.append(rag_data)
-        return rag_data_list
+        return [RAGData(data=data,
+                        distance=0,  # No distance for get operation
+                        metadata=metadata)
+                for data, metadata in results]
+
+    def exists_urls(self, urls: List[str]) -> set:
+        """
+        Check, in a single query, which of the given urls already have documents on the database.
+
+        Args:
+            urls (List[str]): The urls to check.
+
+        Returns:
+            set: The urls that are already on the database.
+        """
+        if not urls:
+            return set()
+        # Each url is checked by containment, so every check is a lookup on the GIN index of metadata
+        query = """
+        SELECT u.url
+        FROM unnest(%s::text[]) AS u(url)
+        WHERE EXISTS (SELECT 1 FROM rag_data WHERE metadata @> jsonb_build_object('url', u.url));
+        """
+        with self._connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, (list(urls),))
+            return {row[0] for row in cursor.fetchall()}
 
     def close(self):
         """
-        Close the database connection.
+        Nothing to close, the connections are borrowed from a pool (shared with other instances) only while they are used.
         """
-        self.cursor.close()
-        self.connection.close()
+        pass
@@ -1,11 +1,76 @@
+import queue
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Iterator, List, Dict, Optional
+
+import numpy as np
+import orjson
 import pyodbc
-from typing import List, Dict
 from uuid import uuid4
 from .base import RAGData, RAGDatabase
+from ..cache import ProximityCache
 from ..embedding import BaseEmbedding
 from .. import SecretRetriever
-from copy import deepcopy
-import json
+
+
+class _ConnectionPool:
+    """
+    A small pool of pyodbc connections. A pyodbc connection can not be used by two threads at the same time,
+    so each operation borrows one. When all of them are in use, the next borrower waits for one to be returned.
+    """
+
+    def __init__(self, connection_string: str, size: int = 8):
+        self.connection_string = connection_string
+        self._idle: "queue.LifoQueue[pyodbc.Connection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self) -> Iterator[pyodbc.Connection]:
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = pyodbc.connect(self.connection_string, autocommit=True)
+            try:
+                yield conn
+            except Exception:
+                # We do not know the state the connection was left in, so it is not reused
+                conn.close()
+                raise
+            self._idle.put(conn)
+
+
+# Supported base types for the embedding column. float16 halves the size of the vectors, but is a preview feature
+VECTOR_TYPES = ('float32', 'float16')
+
+
+@lru_cache(maxsize=None)
+def _get_pool(connection_string: str) -> _ConnectionPool:
+    # One pool per database, shared by every instance that connects to it
+    return _ConnectionPool(connection_string, size=8)
+
+
+def _metadata_decoder():
+    # The chunks of a document share the same metadata, so each distinct string is decoded only once per result
+    decoded: Dict[str, dict] = {}
+
+    def decode(metadata: str) -> dict:
+        meta = decoded.get(metadata)
+        if meta is None:
+            meta = decoded[metadata] = orjson.loads(metadata)
+        # A copy, so the results do not share the same dict
+        return dict(meta)
+    return decode
+
+
+def _vector_json(embedding: List[float]) -> str:
+    # The VECTOR column stores 4 byte floats. Sending float32 values (instead of python doubles) makes the
+    # text about half the size, and orjson writes the numpy array directly.
+    # Every vector (stored or searched) is normalized, so the cosine distance is just 1 - the dot product
+    embedding = np.asarray(embedding, dtype=np.float32)
+    embedding = embedding / (np.linalg.norm(embedding) + 1e-12)
+    return orjson.dumps(embedding, option=orjson.OPT_SERIALIZE_NUMPY).decode()
 
 
 class AzureSQLRAGDatabase(RAGDatabase):
@@ -13,7 +78,7 @@ class AzureSQLRAGDatabase(RAGDatabase):
     A class that extends RAGDatabase and integrates Azure SQL Server for document storage and retrieval.
     """
 
-    def __init__(self, server: str, database: str, username: str, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8):
+    def __init__(self, server: str, database: str, username: str, embedding_function: BaseEmbedding, number_items_to_return: int = 5, max_distance: float = 0.8, query_cache: ProximityCache = None, vector_index: bool = False, vector_type: str = 'float32'):
         """
         Initialize the AzureSQLRAGDatabase instance.
 
@@ -24,41 +89,54 @@ class AzureSQLRAGDatabase(RAGDatabase):
             embedding_function (BaseEmbedding): Embedding function for generating text embeddings.
             number_items_to_return (int): The number of items to return in a query. Defaults to 5.
             max_distance (float): The maximum distance to return similar items. Defaults to 0.8.
+            query_cache (ProximityCache): Cache for the results of near-duplicate queries. Defaults to None (no cache).
+            vector_index (bool): Whether to create a DiskANN vector index and search through it (VECTOR_SEARCH)
+                instead of calculating the distance to every row. It is a preview feature, so PREVIEW_FEATURES must already be
+                ON on the database, and while on preview the table can not be written once it has the index. Defaults to False.
+            vector_type (str): The base type of the embedding column, 'float32' or 'float16' (half the size to store and read).
+                float16 is a preview feature, so PREVIEW_FEATURES must already be ON on the database.
+                Changing it on an existing store requires a reset_store. Defaults to 'float32'.
         """
-        super().__init__(embedding_function, number_items_to_return, max_distance)
+        if vector_type not in VECTOR_TYPES:
+            raise ValueError(f'vector_type must be one of {VECTOR_TYPES}, got {vector_type!r}')
+        super().__init__(embedding_function, number_items_to_return, max_distance, query_cache)
+        self.vector_index = vector_index
+        self.vector_type = vector_type
         password = SecretRetriever.get_secret('AZ_SQL_SERVER_PWD')
         self.connection_string = f"DRIVER={{ODBC Driver 18 for SQL Server}};SERVER={server};DATABASE={database};UID={username};PWD={password}"        
-        self.connection = pyodbc.connect(self.connection_string, autocommit=True)
-        self.cursor = self.connection.cursor()
+        self.pool = _get_pool(self.connection_string)
+        self.embedding_dimension = self.embedding_function.get_embedding_dimension()
+        # The SQL type of the embeddings, used on the column and on the casts
+        self._vector_sql_type = (f"VECTOR({self.embedding_dimension})" if vector_type == 'float32'
+                                 else f"VECTOR({self.embedding_dimension}, {vector_type})")
+        self._hybrid_sql = self._build_hybrid_query()
         self._create_table()
 
     def _create_table(self):
         """
         Create the table for storing text, embeddings, and metadata if it doesn't exist.
         """
-        create_table_query = """
+        # The embeddings are stored on a native VECTOR column (SQL Server 2025 / Azure SQL),
+        # so the distance is calculated by the engine (VECTOR_DISTANCE) instead of on T-SQL
+        create_table_query = f"""
 IF OBJECT_ID(N'dbo.rag_data', N'U') IS NULL
 create table dbo.rag_data
 (
     id UNIQUEIDENTIFIER constraint pk__data primary key,
     data nvarchar(4000),
     metadata nvarchar(4000),
-    embedding nvarchar(max)
+    embedding {self._vector_sql_type} NOT NULL
 );
 
-IF OBJECT_ID(N'rag_embeddings', N'U') IS NULL
-create table dbo.rag_embeddings
-(
-    id UNIQUEIDENTIFIER references dbo.rag_data(id),
-    vector_value_id int,
-    vector_value float
-);
+-- A hash of the url of the document, so it can be looked up with an index seek instead of parsing the metadata of every row.
+-- The url itself could be longer than an index key allows (and would be truncated), its hash always fits
+IF COL_LENGTH('dbo.rag_data', 'url_hash') IS NULL
+ALTER TABLE dbo.rag_data ADD url_hash AS CAST(HASHBYTES('SHA2_256', JSON_VALUE(metadata, '$.url')) AS binary(32)) PERSISTED;
 
-IF NOT EXISTS (SELECT *
+IF NOT EXISTS (SELECT 1
 FROM sys.indexes
-WHERE name = 'csi__rag_embeddings ' AND object_id = OBJECT_ID('dbo.rag_embeddings'))
-create clustered columnstore index csi__rag_embeddings 
-    on dbo.rag_embeddings order (id);
+WHERE name = 'ix_rag_data_url_hash' AND object_id = OBJECT_ID('dbo.rag_data'))
+CREATE INDEX ix_rag_data_url_hash ON dbo.rag_data(url_hash);
 
 if not exists(select *
 from sys.fulltext_catalogs
@@ -74,78 +152,125 @@ create fulltext index on dbo.rag_data (data) key index pk__data;
 
 alter fulltext index on dbo.rag_data enable; 
 """
-        create_function_query = """
-create or alter function dbo.similar_documents(@vector nvarchar(max), @nitens int)
-returns table
-as
-return 
-with
-    cteVector
-    as
-    (
-        select
-            cast([key] as int) as [vector_value_id],
-            cast([value] as float) as [vector_value]
-        from
-            openjson(@vector)
-    ),
-    cteSimilar
-    as
-    (
-        select top (@nitens)
-            v2.id,
-            1-sum(v1.[vector_value] * v2.[vector_value]) / 
-        (
-            sqrt(sum(v1.[vector_value] * v1.[vector_value])) 
-            * 
-            sqrt(sum(v2.[vector_value] * v2.[vector_value]))
-        ) as cosine_distance
-        from
-            cteVector v1
-            inner join
-            dbo.rag_embeddings v2 on v1.vector_value_id = v2.vector_value_id
-        group by
-        v2.id
-        order by
-        cosine_distance
-    )
-select
-    rank() over (order by r.cosine_distance asc) as rank,
-    r.id,
-    r.cosine_distance
-from
-    cteSimilar r;
-        """
-        self.cursor.execute(create_table_query)
-        self.cursor.execute(create_function_query)
-        self.connection.commit()
-
-    def save_text(self, text: str, metadata: dict):
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            # DiskANN indexes and float16 vectors are preview features
+            if self.vector_index:
+                self._check_preview_features(cursor, 'vector_index=True')
+            if self.vector_type != 'float32':
+                self._check_preview_features(cursor, f'vector_type={self.vector_type!r}')
+            self._check_embedding_column(cursor)
+            cursor.execute(create_table_query)
+            if self.vector_index:
+                # Approximate (DiskANN) index, so the search does not scan the whole table
+                cursor.execute("""
+IF NOT EXISTS (SELECT 1
+FROM sys.indexes
+WHERE name = 'vidx__rag_data' AND object_id = OBJECT_ID('dbo.rag_data'))
+CREATE VECTOR INDEX vidx__rag_data ON dbo.rag_data(embedding) WITH (METRIC = 'cosine', TYPE = 'diskann');
+""")
+
+    @staticmethod
+    def _check_embedding_column(cursor: pyodbc.Cursor):
+        """
+        Check that an existing store already has the VECTOR embedding column. A store created with the old
+        nvarchar embeddings (and the rag_embeddings table) can not be searched nor written by this class,
+        and we do not drop its data by ourselves.
+
+        Args:
+            cursor (pyodbc.Cursor): The cursor used to check the column.
+        """
+        row = cursor.execute("""
+SELECT TYPE_NAME(user_type_id)
+FROM sys.columns
+WHERE object_id = OBJECT_ID('dbo.rag_data') AND name = 'embedding';""").fetchone()
+        if row is not None and row[0] != 'vector':
+            raise RuntimeError(f"dbo.rag_data stores the embeddings as {row[0]}, not as VECTOR. It was created by an older "
+                               "version and must be recreated (and its documents indexed again): drop it with "
+                               "'DROP FUNCTION IF EXISTS dbo.similar_documents; DROP TABLE IF EXISTS dbo.rag_embeddings, dbo.rag_data;' "
+                               "(what reset_store does) and build the store again.")
+
+    @staticmethod
+    def _check_preview_features(cursor: pyodbc.Cursor, feature: str):
+        """
+        Check that the database has the preview features turned on. It changes the behavior of the whole database,
+        so it is not something we turn on by ourselves, it must be done beforehand by whoever manages the database.
+
+        Args:
+            cursor (pyodbc.Cursor): The cursor used to check the configuration.
+            feature (str): The option that needs the preview features, for the error message.
+        """
+        # value is a sql_variant, which pyodbc can not read
+        row = cursor.execute(
+            "SELECT CAST(value AS int) FROM sys.database_scoped_configurations WHERE name = 'PREVIEW_FEATURES';").fetchone()
+        if row is None or not row[0]:
+            raise RuntimeError(f"{feature} needs the database preview features, which are off. Turn them on with "
+                               "'ALTER DATABASE SCOPED CONFIGURATION SET PREVIEW_FEATURES = ON;' or do not use it.")
+
+    def reset_store(self):
+        """
+        Drop and recreate the table to reset the store.
+        Needed to move a store created with the old nvarchar embeddings to the VECTOR column.
+        """
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            # The old one row per dimension table (and the function that used it) go too
+            cursor.execute("DROP FUNCTION IF EXISTS dbo.similar_documents; DROP TABLE IF EXISTS dbo.rag_embeddings; DROP TABLE IF EXISTS dbo.rag_data;")
+        self._create_table()
+        self._invalidate_query_cache()
+
+    def save_text(self, text: str, metadata: dict, embedding: Optional[List[float]] = None):
         """
         Save the text and its corresponding embedding to Azure SQL.
 
         Args:
             text (str): The text to be stored.
             metadata (dict): Additional metadata to be stored with the text.
+            embedding (Optional[List[float]]): The embedding of the text, if it was already calculated.
         """
         # Generate embedding
-        embedding = self._calculate_embedding(text)
-        embedding_str = json.dumps(embedding)
-        meta = deepcopy(metadata)
-        meta['id'] = str(metadata.get('id', uuid4()))
+        if embedding is None:
+            embedding = self._calculate_embedding(text, remember=False)
+        self._insert_rows([self._to_row(text, metadata, embedding)])
 
+    def save_texts(self, texts: List[str], metadatas: List[dict], chunk_size: int = 500):
+        """
+        Save several texts to Azure SQL. The embeddings are calculated in a single batch and the rows
+        are sent with executemany, chunk_size rows (and a single commit) at a time.
 
-        # Insert into the database
-        insert_query = """
-                DECLARE @id UNIQUEIDENTIFIER = ?;
-                DECLARE @text nvarchar(4000) = ?;
-                DECLARE @embedding nvarchar(max) = ?;
-                DECLARE @metadata nvarchar(4000) = ?;
-                INSERT INTO dbo.rag_data (id, data, embedding, metadata) VALUES (@id, @text, @embedding, @metadata);
-                INSERT INTO dbo.rag_embeddings SELECT @id, CAST([key] AS INT), CAST([value] AS FLOAT) FROM OPENJSON(@embedding);
+        Args:
+            texts (List[str]): The texts to be stored.
+            metadatas (List[dict]): The metadata of each text, in the same order.
+            chunk_size (int): Number of rows sent on each round trip. Defaults to 500.
         """
-        self.cursor.execute(insert_query, meta['id'], text, embedding_str, json.dumps(metadata))
-        self.connection.commit()
+        embeddings = self._calculate_embeddings(texts, remember=False)
+        self._insert_rows([self._to_row(t, m, e) for t, m, e in zip(texts, metadatas, embeddings)], chunk_size)
+
+    def _to_row(self, text: str, metadata: dict, embedding: List[float]) -> tuple:
+        embedding_str = _vector_json(embedding)
+        # Every row gets its own id. A caller id may not be a valid UNIQUEIDENTIFIER, and as rows are
+        # inserted (not upserted) a repeated one would fail the whole chunk. The metadata is stored as it was given
+        doc_id = str(uuid4())
+        return (doc_id, text, embedding_str, orjson.dumps(metadata).decode())
+
+    def _insert_rows(self, rows: List[tuple], chunk_size: int = 500):
+        if not rows:
+            return
+        insert_query = f"INSERT INTO dbo.rag_data (id, data, embedding, metadata) VALUES (?, ?, CAST(? AS {self._vector_sql_type}), ?);"
+
+        # fast_executemany binds all the parameters of a chunk in a single array and sends them at once,
+        # instead of one round trip per row. Each chunk is committed once, so autocommit is off while saving
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.fast_executemany = True
+            conn.autocommit = False
+            try:
+                for i in range(0, len(rows), chunk_size):
+                    cursor.executemany(insert_query, rows[i:i + chunk_size])
+                    conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.autocommit = True
+        self._invalidate_query_cache()
 
     def query_text(self, query_text: str) -> List[RAGData]:
         """
@@ -157,45 +282,80 @@ from
         Returns:
             List[RAGData]: A list of RAGData objects containing the matched text, similarity score, and metadata.
         """
+        return self.query_texts([query_text])[0]
+
+    def query_texts(self, query_texts: List[str]) -> List[List[RAGData]]:
+        """
+        Search for the most similar texts for each one of the query texts.
+        All the texts are embedded in a single call, and queries already on the query cache are not searched again.
+
+        Args:
+            query_texts (List[str]): The texts to search for.
+
+        Returns:
+            List[List[RAGData]]: One list of RAGData objects for each query text, in the same order.
+        """
+        query_embeddings = self._calculate_embeddings(query_texts)
+        return self._search_with_cache(query_texts, query_embeddings,
+                                       lambda texts, embeddings: self._search_each(texts, embeddings, self._hybrid_search))
+
+    def _hybrid_search(self, query_text: str, query_embedding: List[float]) -> List[RAGData]:
         k = 60
-        # Generate query embedding
+        query_embeddings_str = _vector_json(query_embedding)
 
-        query_embedding = self._calculate_embedding(query_text)
-        query_embeddings_str = json.dumps(query_embedding)
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(self._hybrid_sql, k, self.number_items_to_return * 2, self.number_items_to_return,
+                           query_text, query_embeddings_str)
+            results = cursor.fetchall()
+        
+        # Combine vector and text search results
+        rag_data_list = []
+        decode = _metadata_decoder()
+        for result in results:
+            id, data, metadata, distance, _ = result
+            # Lets just consider elements that are not too far away
+            if distance > self.max_distance:
+                continue
+            rag_data = RAGData(data=data, distance=distance, metadata={"id": id, **decode(metadata)})
+            rag_data_list.append(rag_data)
+    
 
+        return rag_data_list
 
-        # First, perform vector similarity search
-        hybrid_search = f"""
+    def _build_hybrid_query(self) -> str:
+        """
+        Build the hybrid search statement. It is built once, with the sizes as parameters,
+        so the text is always the same and SQL Server reuses its cached plan.
+        Its parameters are: @k the RRF k constant, @k2 the number of items on each search,
+        @top the number of items to return, @text the query text and @embedding the query embedding.
+        """
+        return f"""
          DECLARE @k INT = ?;
+         DECLARE @k2 INT = ?;
+         DECLARE @top INT = ?;
          DECLARE @text NVARCHAR(4000) = ?;
-         DECLARE @embedding NVARCHAR(max) = ?;         
+         DECLARE @embedding {self._vector_sql_type} = CAST(CAST(? AS NVARCHAR(max)) AS {self._vector_sql_type});
             WITH keyword_search AS (
                 SELECT
                     id,
                     data,
                     metadata,
+                    1 + VECTOR_DISTANCE('dot', embedding, @embedding) AS distance,
                     rank() over (order by ftt.[RANK] desc) AS rank
                 FROM 
                     dbo.rag_data 
                 INNER JOIN 
-                    FREETEXTTABLE(dbo.rag_data, data, @text, {self.number_items_to_return * 2}) AS ftt ON dbo.rag_data.id = ftt.[KEY]
+                    FREETEXTTABLE(dbo.rag_data, data, @text, @k2) AS ftt ON dbo.rag_data.id = ftt.[KEY]
             ),
             semantic_search AS
             (
-                SELECT 
-                    d.id, 
-                    d.data,
-                    d.metadata,
-                    s.rank                    
-                FROM 
-                    dbo.similar_documents(@embedding, {self.number_items_to_return * 2}) AS s
-                INNER JOIN 
-                    dbo.rag_data AS d on s.id = d.id                
+                {self._semantic_search_query()}
             )
-            SELECT TOP({self.number_items_to_return})
+            SELECT TOP(@top)
                 COALESCE(ss.id, ks.id) AS id,
                 COALESCE(ss.data, ks.data) AS data,
                 COALESCE(ss.metadata, ks.metadata) AS metadata,
+                COALESCE(ss.distance, ks.distance) AS distance,
                 COALESCE(1.0 / (@k + ss.rank), 0.0) +
                 COALESCE(1.0 / (@k + ks.rank), 0.0) 
                 AS score -- Reciprocal Rank Fusion (RRF) 
@@ -206,18 +366,35 @@ from
             ORDER BY 
                 score DESC
         """
-        self.cursor.execute(hybrid_search, k, query_text, query_embeddings_str)
-        results = self.cursor.fetchall()
-        
-        # Combine vector and text search results
-        rag_data_list = []
-        for result in results:
-            id, data, metadata, _ = result
-            rag_data = RAGData(data=data, distance=0, metadata={"id": id, **json.loads(metadata)})
-            rag_data_list.append(rag_data)
-    
 
-        return rag_data_list
+    def _semantic_search_query(self) -> str:
+        if self.vector_index:
+            # Top k probe on the DiskANN index
+            return """
+                SELECT
+                    t.id,
+                    t.data,
+                    t.metadata,
+                    s.distance,
+                    RANK() OVER (ORDER BY s.distance ASC) AS rank
+                FROM
+                    VECTOR_SEARCH(TABLE = dbo.rag_data AS t, COLUMN = embedding, SIMILAR_TO = @embedding,
+                                  METRIC = 'cosine', TOP_N = @k2) AS s"""
+
+        return """
+                -- The distance is calculated once per row, on the inner query.
+                -- The vectors are normalized, so the cosine distance is 1 + the negative dot product VECTOR_DISTANCE returns
+                SELECT TOP(@k2)
+                    id,
+                    data,
+                    metadata,
+                    distance,
+                    RANK() OVER (ORDER BY distance ASC) AS rank
+                FROM (
+                    SELECT id, data, metadata, 1 + VECTOR_DISTANCE('dot', embedding, @embedding) AS distance
+                    FROM dbo.rag_data
+                ) AS v
+                ORDER BY distance ASC"""
 
     def get(self, attributes: Dict = {}) -> List[RAGData]:
         """
@@ -232,24 +409,53 @@ from
         filters = []
         values = []
         for key, value in attributes.items():
-            filters.append(f"JSON_VALUE(metadata, '$.{key}') = ?")
+            if key == 'url':
+                # Seeks the index on the hash of the url (hashed as nvarchar, as JSON_VALUE returns it),
+                # then compares the url itself
+                filters.append("url_hash = HASHBYTES('SHA2_256', CAST(? AS nvarchar(4000))) AND JSON_VALUE(metadata, '$.url') = ?")
+                values.append(value)
+            else:
+                filters.append(f"JSON_VALUE(metadata, '$.{key}') = ?")
             values.append(value)
 
         filter_query = " AND ".join(filters) if filters else "1=1"
-        query = f"SELECT top {self.number_items_to_return} data, metadata FROM rag_data WHERE {filter_query} ;"        
-        self.cursor.execute(query, values)
-        results = self.cursor.fetchall()
+        query = f"SELECT TOP (?) data, metadata FROM rag_data WHERE {filter_query} ;"
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, self.number_items_to_return, *values)
+            results = cursor.fetchall()
 
         rag_data_list = []
+        decode = _metadata_decoder()
         for result in results:
             data, metadata = result
-            rag_data = RAGData(data=data, distance=0, metadata=json.loads(metadata))
+            rag_data = RAGData(data=data, distance=0, metadata=decode(metadata))
             rag_data_list.append(rag_data)
         return rag_data_list
 
+    def exists_urls(self, urls: List[str]) -> set:
+        """
+        Check, in a single query, which of the given urls already have documents on Azure SQL.
+
+        Args:
+            urls (List[str]): The urls to check.
+
+        Returns:
+            set: The urls that are already on the database.
+        """
+        if not urls:
+            return set()
+        # Joins on the (indexed) hash of the urls, then compares the urls themselves
+        query = """
+SELECT DISTINCT u.url
+FROM (SELECT CAST(value AS nvarchar(4000)) AS url FROM OPENJSON(?)) AS u
+JOIN dbo.rag_data AS d
+    ON d.url_hash = HASHBYTES('SHA2_256', u.url) AND JSON_VALUE(d.metadata, '$.url') = u.url;"""
+        with self.pool.connection() as conn, conn.cursor() as cursor:
+            cursor.execute(query, orjson.dumps(list(urls)).decode())
+            return {row[0] for row in cursor.fetchall()}
+
     def close(self):
         """
-        Close the database connection.
+        Nothing to close, the connections are borrowed from a pool (shared with other instances) only while they are used.
         """
-        self.cursor.close()
-        self.connection.close()
+        pass
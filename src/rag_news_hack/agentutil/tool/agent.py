@@ -1,20 +1,39 @@
 from inspect import Parameter, Signature
-from typing import Annotated
+from string import Formatter
+from typing import Annotated, Optional
 
 from ..agent.base import SimpleAgent
 from .base import BasicTool
 
 
+def _compile_template(template: str) -> Optional[list[tuple[str, Optional[str]]]]:
+    # Parse the template once, as (literal text, field name) pieces.
+    # Only plain {question}/{text} fields are supported, anything else (specs, conversions) uses str.format
+    pieces = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        if field is not None and (field not in ('question', 'text') or spec or conversion):
+            return None
+        pieces.append((literal, field))
+    return pieces
+
+
 class AgentTool(BasicTool):
     def __init__(self, agent: SimpleAgent, name: str, description: str, question_template: str = 'Review the text bellow. Its title is {question}\n\n{text}'):
         super().__init__(name=name, description=description)
         self.agent = agent
         self.question_template = question_template
+        self._template_pieces = _compile_template(question_template)
 
     def __call__(self, **kwargs) -> str:
         question = kwargs['question']
         text = kwargs['text']
-        return self.agent.answer_question(question=self.question_template.format(question=question, text=text))
+        if self._template_pieces is None:
+            prompt = self.question_template.format(question=question, text=text)
+        else:
+            values = {'question': str(question), 'text': str(text)}
+            prompt = ''.join(literal + values[field] if field else literal
+                             for literal, field in self._template_pieces)
+        return self.agent.answer_question(question=prompt)
 
     @classmethod
     def set_signature(cls):
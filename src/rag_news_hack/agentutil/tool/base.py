@@ -1,8 +1,9 @@
 from abc import abstractmethod
-from collections import defaultdict
 from inspect import Parameter, Signature
 from typing import Annotated, Any, Dict, TypedDict
 
+import numpy as np
+
 from ..ragstore import RAGData, RAGDatabase
 
 
@@ -19,7 +20,11 @@ class BasicTool():
         self.name = name
         self.__name__ = name
         self.description = description
-        self.set_signature()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # The signature is the same for every instance, so it is set once, when the class is defined
+        cls.set_signature()
 
     @classmethod
     @abstractmethod
@@ -71,39 +76,50 @@ class RagTool(BasicTool):
             parameters=params, return_annotation=Annotated[str, 'Informacoes recuperadas da base de RAG'])
 
     def __call__(self, **kwargs) -> str:
-        res: list[str] = []
         data: dict[str, list[RAGData]] = {}
         k = 60
 
         queries: list[str] = kwargs.get('queries', [])
-        for query in queries:
-            data[query] = self.rag_store.query_text(query)
+        if not queries:
+            return ''
+
+        # Repeated queries are searched only once, and all of them are embedded (and searched) in a single batch
+        unique_queries = list(dict.fromkeys(queries))
+        data = dict(zip(unique_queries, self.rag_store.query_texts(unique_queries)))
 
         #Lets get the result length, so we can return the same number of itens
-        len_result = len(data[query])
+        len_result = len(data[queries[-1]])
 
         # Do RRF on the results
-        # To store the RRF scores for each "ID"
-        scores: dict[str, float] = defaultdict(float)
-        # To store which lists each ID appeared in
-        rank_map: dict[str, RAGData] = defaultdict()
-
-        # Loop over each list of RAGData for each source
-        for _, rag_list in data.items():
+        # Each ID gets an integer index, so the RRF scores are accumulated on an array
+        index: dict[str, int] = {}
+        # The RAGData of each index (the last one seen, as before)
+        rank_map: list[RAGData] = []
+        id_indices: list[np.ndarray] = []
+        for rag_list in data.values():
+            indices = np.empty(len(rag_list), dtype=np.intp)
             for rank, rag in enumerate(rag_list):
-                id = rag.metadata['id']                
-                # Update the RRF score for the ID
-                scores[id] += 1 / (k + rank + 1)
-                rank_map[id] = rag
-
-        # Sort IDs by their RRF scores (highest score first)
-        sorted_ids = sorted(
-            scores.keys(), key=lambda x: scores[x], reverse=True)
-
-        # Create a final ranked list of RAGData objects
-        final_data = [rank_map[id] for id in sorted_ids]
-
-        for d in final_data[:len_result]:
-            f = f"#URL:{d.metadata['url']}\n {d.data}\n\n"
-            res.append(f)        
-        return '\n\n'.join(res)
+                i = index.setdefault(rag.metadata['id'], len(index))
+                if i == len(rank_map):
+                    rank_map.append(rag)
+                else:
+                    rank_map[i] = rag
+                indices[rank] = i
+            id_indices.append(indices)
+
+        if not rank_map:
+            return ''
+
+        # The reciprocal rank of each position, calculated once for all the lists
+        max_len = max(len(indices) for indices in id_indices)
+        weights = 1.0 / (k + np.arange(max_len) + 1)
+        scores = np.zeros(len(rank_map))
+        for indices in id_indices:
+            np.add.at(scores, indices, weights[:len(indices)])
+
+        # The len_result IDs with the best RRF scores (highest score first).
+        # A stable sort, so ties keep the order the IDs were first seen
+        top = np.argsort(-scores, kind='stable')[:len_result]
+
+        # Build the answer straight from the ranked RAGData objects
+        return '\n\n'.join(f"#URL:{d.metadata['url']}\n {d.data}\n\n" for d in (rank_map[i] for i in top))
@@ -1,4 +1,5 @@
 from datetime import datetime
+from functools import lru_cache
 from rss_index import index
 
 import dotenv
@@ -10,8 +11,8 @@ from agentutil.tool import AgentTool, RagTool
 
 dotenv.load_dotenv()
 
-system_prompt = f"""Hoje é {datetime.now().isoformat()}
-You are a news verifier AI Assistant. You are a seasoned journalist with experience and understand the complexity and nuances of real world information;
+# The date is added on each message (see response), so it does not freeze at the time the app started
+system_prompt = """You are a news verifier AI Assistant. You are a seasoned journalist with experience and understand the complexity and nuances of real world information;
 
 Given an information/news article (the AFIRMATION) your task is to check if it (or parts of it) are true or not. For each part of the REFERENCE you should explain WHY it is true or not.
 
@@ -60,26 +61,41 @@ A afirmativa é construída sobre uma situação complexa onde a Ucrânia realme
 ### TRUTHNESS(0-10): 6
 """
 
-config_store = JSONStore('json_config_store')
+# The config store is only built when first needed (not on import), and then reused by every message.
+# The rag stores are already shared by instantiate_from_config, and the tools are cheap to build
 
 
-def response(message, history, selecao):
+@lru_cache(maxsize=None)
+def get_config_store() -> JSONStore:
+    return JSONStore('json_config_store')
+
 
+def get_rag_tool(selecao: str) -> RagTool:
+    config_store = get_config_store()
     rag_store = instantiate_from_config(
         config_store.get_config('ragstore', selecao),
         config_store)
+    return RagTool(rag_store=rag_store)
 
-    rag_tool = RagTool(rag_store=rag_store)
 
+def get_reviewer_tool() -> AgentTool:
+    # Built on each message, so the reviewer always gets the current date
     reviewer_prompt = f'Today is {datetime.now().isoformat()}\nYou are a content reviewer. You should review texts sent to you by a writer. These texts are atemps to explain if a given afirmation/news is true or not. When given a text you will review it and provide tips on how to improve it. If you think the text is good already make it clear in your answer'
     llm_reviewer = OpenAIAgent(system_prompt=reviewer_prompt)
 
-    reviewer_tool = AgentTool(agent=llm_reviewer,
-                              name='Text_reviewer',
-                              description='Call this tool to get feedback on your answers. It will return information on the quality of the provided text and how you can improve it.')
+    return AgentTool(agent=llm_reviewer,
+                     name='Text_reviewer',
+                     description='Call this tool to get feedback on your answers. It will return information on the quality of the provided text and how you can improve it.')
+
+
+def response(message, history, selecao):
+
+    rag_tool = get_rag_tool(selecao)
+    reviewer_tool = get_reviewer_tool()
 
+    # The agent keeps the state of its chat, so each message gets its own
     agent_config = {
-        'system_prompt': system_prompt,
+        'system_prompt': f'Hoje é {datetime.now().isoformat()}\n{system_prompt}',
         'model': 'gpt-4o-mini',
         'api_type': 'openai',
     }
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import feedparser
 
 from agentutil import instantiate_from_config
@@ -47,13 +49,25 @@ def index(store: str = 'postgres'):
     for rss in rss_urls:
         urls.extend(get_rss_urls(rss))
     # urls = []
-    for u in urls:        
-        res = rag_store.get({'url': u})
-        if len(res) > 0:
+    # The feeds can share news, so each url is checked (and indexed) only once
+    urls = list(dict.fromkeys(urls))
+
+    # Lets check all the urls at once, instead of one query for each
+    existing_urls = rag_store.exists_urls(urls)
+    for u in urls:
+        if u in existing_urls:
             yield f'{u}\n\tALREADY INDEXED'
-        else:
-            yield f'{u}\n\tINDEXING'
-            indexer_pg.index(u)
 
+    # Downloading the pages is network bound, so several are indexed at the same time
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        futures = {executor.submit(indexer_pg.index, u): u for u in urls if u not in existing_urls}
+        for future in as_completed(futures):
+            # A page that fails (download, parsing, saving) is reported, and the others keep being indexed
+            try:
+                future.result()
+            except Exception as e:
+                yield f'{futures[future]}\n\tFAILED: {e}'
+            else:
+                yield f'{futures[future]}\n\tINDEXED'
 
-    rag_store.close()
+    # The store is not closed here: instances built from the config are shared with the rest of the application